@@ -2,14 +2,36 @@
 
 import argparse
 import cmd
+import io
+import json
 import os
+import shutil
+import socketserver
+import stat
 import sys
 import textwrap
-from tempfile import mkdtemp, NamedTemporaryFile
-from functools import partial
+import threading
+from collections import Counter
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import contextmanager, nullcontext
+from tempfile import mkdtemp, NamedTemporaryFile, TemporaryDirectory
+from functools import partial, wraps
+from itertools import count, islice
 
 from pypd import PdParser
-from pd import pd
+from pypd import PdTrace
+from pypd.PdAcks import PdEditError
+from pypd.PdDiff import PdIncrementalParser
+from pypd.PdTrace import traced
+from pypd.PdWriter import OBJECT_ACTIONS
+from pypd.PdCoalescer import DEFAULT_WINDOW
+from pypd.PdResolver import PdResolver
+from pd import pd, PdException
+from pdcompile import ChainCompiler, effectPosition, writePatchBay
+import pdrender
+from pdprofile import PdCostDb, PROFILE_SECONDS
+import pdlint
+from pdindex import PdClassIndex
 import pdgui
 
 PD_BIN = os.environ.get("PD_BIN", os.path.join(os.sep, "usr", "bin", "pd"))
@@ -17,15 +39,38 @@ PD_SEND = os.path.join(os.environ.get("PD_BIN", os.path.dirname(PD_BIN)),
                        "pdsend")
 PATCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "patches")
 INIT_PATCH = "patchbay.pd"
+SCRIPT_BATCH_LINES = 32
+SWAP_FADE_MS = 50
+SYNC_TIMEOUT = 5.0
 
 
 class PdPatch(object):
-    def __init__(self, patchPath=None, channel=1, pd=None):
+    def __init__(self, patchPath=None, channel=1, pd=None, lazy=False):
+        """
+        With lazy=True only the top level canvas and the GUI controls are
+        read: self.objects holds the top level's objects only, and the
+        subpatches are left unparsed until expand() is asked for them.
+        """
         self.objectCount = 0
         self.channel = channel
         self.objects = []
+        # {canvas path: positions in self.objects}, in the order Pd numbers
+        # the objects on each canvas; the path is "-" for the top level, as
+        # PdIncrementalParser has it
+        self._numbers = {}
         self.guiIndices = []
+        self.controls = []
+        # GUI controls by their receive and send symbols
+        self.receives = {}
+        self.sends = {}
         self.pd = pd
+        # follows the file's elements so update() can find what changed
+        self._source = None
+        # for a lazy load, {object number: (canvas stack, start, end)} of the
+        # subpatches not read yet, and the models of those expanded since
+        self.subpatches = None
+        self._expanded = {}
+        self._parser = None
 
         if patchPath:
             patchDir, patchName = os.path.split(patchPath)
@@ -35,16 +80,50 @@ class PdPatch(object):
                 fileName, self.name = patchName + ".pd", patchName
 
             p = PdParser(os.path.join(patchDir, fileName))
-            p.add_filter_method(self.found_io, type="#X", object="adc~")
-            p.add_filter_method(self.found_io, type="#X", object="dac~")
-            p.add_filter_method(self.found_connect, type="#X",
-                                action="connect")
-            for cls in pdgui.PdGui.__subclasses__():
-                p.add_filter_method(partial(self.found_object, cls), type="#X",
-                                    object=cls.__name__)
-            p.add_filter_method(partial(self.found_object, pdgui.PdObject),
-                                type="#X")
-            print(p.parse(), "elements in this patch.")
+            if lazy:
+                self.subpatches = {}
+                self._addFilters(p, canvas=p.filename)
+                self.subpatches = p.parseLazily(pattern=pdgui.guiPattern)
+                self._parser = p
+            else:
+                self._addFilters(p)
+                print(p.parse(), "elements in this patch.")
+                self._source = PdIncrementalParser(p.filename, p.contents)
+
+    @staticmethod
+    def _canvasPath(canvasStack):
+        return "/".join(canvasStack[1:]) or "-"
+
+    def _addFilters(self, p, canvas=None):
+        # With canvas given, objects and connections only come from that
+        # canvas, while GUI controls still come from anywhere.
+        scope = {"canvas": canvas} if canvas else {}
+        p.add_filter_method(self.found_io, type="#X", object="adc~", **scope)
+        p.add_filter_method(self.found_io, type="#X", object="dac~", **scope)
+        p.add_filter_method(self.found_connect, type="#X", action="connect",
+                            **scope)
+        for objName, cls in pdgui.guiClasses.items():
+            p.add_filter_method(partial(self.found_object, cls), type="#X",
+                                object=objName)
+        p.add_filter_method(partial(self.found_object, pdgui.PdObject),
+                            type="#X", **scope)
+
+    def expand(self, index):
+        """The model of the subpatch at object number index on the top
+        level, which a lazy load skipped, parsing it from the file as it was
+        loaded the first time it's asked for."""
+        if index not in self._expanded:
+            canvasStack, start, end = self.subpatches["-", index]
+            subpatch = PdPatch(channel=self.channel, pd=self.pd)
+            subpatch.name = canvasStack[-1]
+            filters, self._parser.filters = self._parser.filters, []
+            try:
+                subpatch._addFilters(self._parser, canvas=canvasStack[-1])
+                self._parser.parseRange(start, end, canvasStack)
+            finally:
+                self._parser.filters = filters
+            self._expanded[index] = subpatch
+        return self._expanded[index]
 
     def _connectSockets(self, fromSocket, toSocket, twoWay=True):
         self.objects[fromSocket.index].outlets[fromSocket.position] = toSocket
@@ -53,8 +132,9 @@ class PdPatch(object):
 
     def found_connect(self, canvasStack, type, action, args):
         obj1, outlet, obj2, inlet = map(int, args.split())
-        self._connectSockets(pdgui.socket(obj1, outlet),
-                             pdgui.socket(obj2, inlet))
+        positions = self._numbers[self._canvasPath(canvasStack)]
+        self._connectSockets(pdgui.socket(positions[obj1], outlet),
+                             pdgui.socket(positions[obj2], inlet))
 
     def found_io(self, canvasStack, type, action, args):
         pass
@@ -63,16 +143,39 @@ class PdPatch(object):
         if action == "connect":
             return
         if cls is pdgui.PdObject:
+            if action not in OBJECT_ACTIONS:
+                # "#X coords" and the like aren't objects Pd numbers
+                return
+            self._numbers.setdefault(self._canvasPath(canvasStack),
+                                     []).append(len(self.objects))
             self.objects.append(cls(args.split()))
             self.objectCount += 1
         else:
-            self.guiIndices.append(self.objectCount - 1)
+            # the generic PdObject filter for this element runs after this
+            # one, except for controls in subpatches a lazy load skipped
+            if self.subpatches is None or len(canvasStack) == 1:
+                self.guiIndices.append(self.objectCount)
+            self._addControl(cls(args.split()))
             print("canvasStack:", canvasStack,
                   "type:", type,
                   "action:", action,
                   "arguments:", args.split())
 
+    def _addControl(self, control):
+        self.controls.append(control)
+        if control.addressable():
+            self.receives[control.receive] = control
+        if getattr(control, "send", "empty") != "empty":
+            self.sends[control.send] = control
+
+    def found_control(self, cls, parser, canvasStack, type, action, args):
+        # a GUI control on a lazy re-read, before any object is modelled
+        if len(canvasStack) == 1:
+            self.guiIndices.append(parser.objectIndex)
+        self._addControl(cls(args.split()))
+
     def add(self, objectArgs):
+        self._numbers.setdefault("-", []).append(len(self.objects))
         self.objects.append(pdgui.PdObject(objectArgs))
         self.pd.send(" ".join(["obj"] + objectArgs))
         return len(self.objects) - 1
@@ -80,7 +183,21 @@ class PdPatch(object):
     def getObj(self, index):
         return self.objects[index]
 
-    def removeObjectAt(self, index):
+    def _shiftSockets(self, start, by):
+        # Pd renumbers every object after one added or removed, so shift
+        # all sockets pointing at or past start
+        def shifted(s):
+            if s.index >= start:
+                return pdgui.socket(s.index + by, s.position)
+            return s
+
+        for obj in self.objects:
+            obj.inlets = {pos: shifted(s) for pos, s in obj.inlets.items()}
+            obj.outlets = {pos: shifted(s) for pos, s in obj.outlets.items()}
+        for positions in self._numbers.values():
+            positions[:] = [p + by if p >= start else p for p in positions]
+
+    def _dropObject(self, index):
         objectToRemove = self.objects[index]
         # Remove this object's inbound connections from other objects
         for outSocket in objectToRemove.inlets.values():
@@ -88,36 +205,120 @@ class PdPatch(object):
         # Remove this object's outbound connections from other objects
         for inSocket in objectToRemove.outlets.values():
             self.objects[inSocket.index].inlets.pop(inSocket.position)
+        removedObj = self.objects.pop(index)
+        for positions in self._numbers.values():
+            if index in positions:
+                positions.remove(index)
+        self._shiftSockets(index + 1, -1)
+        return removedObj
 
-        # Find this object and remove it
-        self.pd.send(" ".join(["find", objectToRemove.name, "1"]))
-        for i in range(sum(obj.name == objectToRemove.name
+    def removeObjectAt(self, index):
+        objectToRemove = self.objects[index]
+        # Find this object by its whole text and remove it
+        text = [objectToRemove.name] + objectToRemove.args
+        self.pd.send(" ".join(["find"] + text + ["1"]))
+        for i in range(sum([obj.name] + obj.args == text
                        for obj in self.objects[:index])):
             self.pd.send("findagain")
         self.pd.send("cut")
+        return self._dropObject(index)
+
+    def _indexControls(self):
+        self.guiIndices, self.controls = [], []
+        self.receives, self.sends = {}, {}
+        for i, obj in enumerate(self.objects):
+            cls = pdgui.guiClasses.get(getattr(obj, "name", None))
+            if cls is None:
+                continue
+            self.guiIndices.append(i)
+            self._addControl(cls([obj.x_pos, obj.y_pos, obj.name] + obj.args))
+
+    def _indexLazily(self):
+        # Read the controls and where the skipped subpatches are again, the
+        # way a lazy load does, so expand() finds them in the new file.
+        p = PdParser(self._parser.filename)
+        self.guiIndices, self.controls = [], []
+        self.receives, self.sends = {}, {}
+        for objName, cls in pdgui.guiClasses.items():
+            p.add_filter_method(partial(self.found_control, cls, p),
+                                type="#X", object=objName)
+        self.subpatches = p.parseLazily(pattern=pdgui.guiPattern)
+        p.filters = []
+        self._parser, self._expanded = p, {}
+
+    def update(self):
+        """Bring the model up to date with edits to the patch file, only
+        re-reading what changed. Returns the changes (PdChanges) applied:
+        those on every canvas, or for a lazy load only those on the top
+        level, which is all it models."""
+        if self._source is None and self._parser is not None:
+            # a lazy load puts off reading every element until now
+            self._source = PdIncrementalParser(self._parser.filename,
+                                               self._parser.contents)
+        if self._source is None:
+            return []
+        changes = self._source.update()
+        if self._parser is not None:
+            changes = [c for c in changes if c.canvas == "-"]
+        for change in changes:
+            getattr(self, "_apply_" + change.kind)(change)
+        if self._parser is not None:
+            # subpatch byte ranges move with any edit
+            self._indexLazily()
+        elif any(c.kind in ("add", "remove", "change") for c in changes):
+            self._indexControls()
+        return changes
+
+    def _position(self, canvas, number):
+        # where object number on canvas sits in self.objects
+        return self._numbers[canvas][number]
+
+    def _sockets(self, change):
+        fromObj, outlet, toObj, inlet = change.index
+        return (pdgui.socket(self._position(change.canvas, fromObj), outlet),
+                pdgui.socket(self._position(change.canvas, toObj), inlet))
 
-        # Adjust indices of removed object's outgoing sockets to higher indices
-        for pos, outgoingSocket in objectToRemove.outlets.items():
-            if outgoingSocket.index >= index:
-                fixedSocket = pdgui.socket(outgoingSocket.index - 1,
-                                           outgoingSocket.position)
-                self._connectSockets(pdgui.socket(index, pos), fixedSocket,
-                                     twoWay=False)
+    def _apply_disconnect(self, change):
+        fromSocket, toSocket = self._sockets(change)
+        if self.hasConnection(fromSocket, toSocket):
+            self.objects[fromSocket.index].outlets.pop(fromSocket.position)
+            self.objects[toSocket.index].inlets.pop(toSocket.position)
+
+    def _apply_remove(self, change):
+        self._dropObject(self._position(change.canvas, change.index))
+
+    def _apply_add(self, change):
+        # right after the object before it, ahead of the contents of a
+        # subpatch that follows, so self.objects stays in file order
+        positions = self._numbers.setdefault(change.canvas, [])
+        if change.index:
+            at = positions[change.index - 1] + 1
+        elif change.canvas == "-":
+            at = 0
+        else:
+            at = min([p for path, inner in self._numbers.items()
+                      if path == change.canvas or
+                      path.startswith(change.canvas + "/") for p in inner],
+                     default=len(self.objects))
+        self._shiftSockets(at, 1)
+        positions.insert(change.index, at)
+        self.objects.insert(at, pdgui.PdObject(change.element.split()[2:]))
 
-        # Adjust all incoming connections to objects after the removed one
-        for i, obj in enumerate(self.objects[index + 1:]):
-            for pos, incomingSocket in obj.inlets.items():
-                fixedSocket = pdgui.socket(i + index, pos)
-                self._connectSockets(incomingSocket, fixedSocket,
-                                     twoWay=False)
+    def _apply_change(self, change):
+        at = self._position(change.canvas, change.index)
+        obj = pdgui.PdObject(change.element.split()[2:])
+        old = self.objects[at]
+        obj.inlets, obj.outlets = old.inlets, old.outlets
+        self.objects[at] = obj
 
-        return self.objects.pop(index)
+    def _apply_connect(self, change):
+        self._connectSockets(*self._sockets(change))
 
     def hasConnection(self, fromSocket, toSocket):
         return (
-            self.objects[fromSocket.index].outlets[fromSocket.position]
+            self.objects[fromSocket.index].outlets.get(fromSocket.position)
             == toSocket and
-            self.objects[toSocket.index].inlets[toSocket.position]
+            self.objects[toSocket.index].inlets.get(toSocket.position)
             == fromSocket
         )
 
@@ -146,72 +347,647 @@ def fileNameInsert(f, insert):
     return start + "_" + str(insert) + end
 
 
+def _locked(method):
+    # Run a patch bay method holding its lock, so operations from other
+    # threads (server clients, swap timers) never interleave with it.
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class PdPatchBay(object):
-    def __init__(self, patchDir=PATCH_DIR, nogui=True):
+    def __init__(self, patchDir=PATCH_DIR, nogui=True,
+                 controlWindow=DEFAULT_WINDOW, budget=None,
+                 strictBudget=False, pool=None, inputs=2, outputs=None):
         self.patchDir = patchDir
         self.availPatches = [p for p in os.listdir(self.patchDir)
                              if os.path.splitext(p)[0].endswith("~")]
-        self.effects = ({}, {})
-        self.pd = pd(initPatch=os.path.join(patchDir, INIT_PATCH), nogui=nogui)
-        self.patch = PdPatch(patchPath=os.path.join(patchDir, INIT_PATCH),
-                             channel=None,
+        outputs = inputs if outputs is None else outputs
+        # one chain per input, each feeding any set of outputs
+        self.effects = tuple({} for c in range(inputs))
+        self.routes = [{c} if c < outputs else set() for c in range(inputs)]
+        self.resolver = PdResolver([patchDir])
+        # the patch Pd runs is generated for this many inputs and outputs;
+        # effects are found along Pd's search path instead of next to it
+        self.basePatch = os.path.join(mkdtemp(prefix="patchbay-"),
+                                      INIT_PATCH)
+        self.ins, self.outs, self.dacs = writePatchBay(
+            self.basePatch, inputs, outputs, self.routes)
+        self.pd = pd(initPatch=self.basePatch, nogui=nogui,
+                     controlWindow=controlWindow, path=[patchDir],
+                     inchannels=inputs, outchannels=outputs)
+        self.patch = PdPatch(patchPath=self.basePatch, channel=None,
                              pd=self.pd)
-        self.ins, self.outs = [2, 3], [4, 5]
-
-    def _chainConnect(self, newObjIndex, channel):
-        # disconnect dac from previous patch
-        toIndex = self.outs[channel]
-        outObj = self.patch.getObj(toIndex)
-        previousOutlet = outObj.inlets[0]
-        self.patch.disconnect(previousOutlet,
-                              pdgui.socket(toIndex, 0))
-        # connect previous patch to new patch
-        self.patch.connect(previousOutlet,
-                           pdgui.socket(newObjIndex, 0))
-        # connect new patch to dac
-        self.patch.connect(pdgui.socket(newObjIndex, 0),
-                           pdgui.socket(self.outs[channel], 0))
+        # The model holds one link per outlet, so links from the chain ends
+        # to the [dac~]s are kept in self.routes instead
+        for end in self.outs:
+            for toSocket in self.patch.getObj(end).outlets.values():
+                self.patch.getObj(toSocket.index).inlets.pop(
+                    toSocket.position, None)
+            self.patch.getObj(end).outlets.clear()
+        # control values set through set_control, by receive symbol
+        self.controlValues = {}
+        # what changed since the last snapshot was written
+        self._snapshotPath = None
+        self._dirtyChannels = set()
+        self._dirtyControls = set()
+        # running controls by receive symbol, rebuilt after chain changes
+        self._controlIndex = None
+        # measured effect costs and the most of a CPU core one channel may
+        # use; over it, starting effects warns, or fails with strictBudget
+        self.costs = PdCostDb(patchDir)
+        self.budget = budget
+        self.strictBudget = strictBudget
+        # object classes and receive names used across patchDir, built on
+        # first use
+        self._classIndex = None
+        # crossfades still running, finished by a timer or the next edit
+        self._swaps = []
+        self._swapIds = count(1)
+        # held by every operation changing the model or sending edits, as
+        # swap timers settle from their own threads
+        self.lock = threading.RLock()
+        # effects created ahead of time and sitting unconnected, by name,
+        # handed out by start and taken back by stop
+        self._idle = {}
+        self._poolIds = count(1)
+        self._poolSizes = {}
+        self.usage = Counter()
+        if pool:
+            self.resize_pool(pool)
 
-    def start(self, name, channel=0):
+    def _chain(self, channel):
+        return ([self.ins[channel]] +
+                [index for patch, index in self.effects[channel].values()] +
+                [self.outs[channel]])
+
+    def _rewireChain(self, channel):
+        # Make the connections along the channel match the order of
+        # self.effects[channel], only touching links that actually changed.
+        self._dirtyChannels.add(channel)
+        self._controlIndex = None
+        chain = self._chain(channel)
+        for fromIndex, toIndex in zip(chain, chain[1:]):
+            fromSocket = pdgui.socket(fromIndex, 0)
+            toSocket = pdgui.socket(toIndex, 0)
+            current = self.patch.getObj(fromIndex).outlets.get(0)
+            if current == toSocket:
+                continue
+            if current is not None:
+                self.patch.disconnect(fromSocket, current)
+            self.patch.connect(fromSocket, toSocket)
+
+    def _createEffect(self, name, channel, slot):
         newPatch = PdPatch(
             patchPath=os.path.join(self.patchDir, name),
             channel=channel + 1,
+            lazy=True,
         )
-        objectArgs = list(map(str, [
-            315 if channel else 40,
-            80 + 40 * (len(self.effects[channel]) + 1),
-            name
-        ]))
-        newIndex = self.patch.add(objectArgs)
-        self._chainConnect(newIndex, channel)
-        self.effects[channel][name] = (newPatch, newIndex)
+        objectArgs = list(map(str, effectPosition(channel, slot) + (name, )))
+        return newPatch, self.patch.add(objectArgs)
 
-    def stop(self, name, channel=0):
-        if name in self.effects[channel]:
-            patch, index = self.effects[channel].pop(name)
-            removedObj = self.patch.removeObjectAt(index)
-            self.patch.connect(removedObj.inlets[0],
-                               removedObj.outlets[0])
+    def _createPooled(self, name, slot):
+        # An effect for the pool, inside a [pd pool-<n>] subpatch whose
+        # [switch~] keeps its DSP off while it sits idle, parked in a column
+        # right of the channels
+        newPatch = PdPatch(patchPath=os.path.join(self.patchDir, name),
+                           lazy=True)
+        receive = "pool-{}".format(next(self._poolIds))
+        x, y = effectPosition(len(self.effects), slot)
+        index = self.patch.add([str(x), str(y), "pd", receive])
+        for atoms in [(10, 10, "inlet~"), (10, 40, name), (10, 70, "outlet~"),
+                      (80, 10, "r", receive), (80, 40, "switch~")]:
+            self.pd.send(" ".join(map(str, ("ctl", "pd-" + receive, "obj") +
+                                      atoms)))
+        for connection in [(0, 0, 1, 0), (1, 0, 2, 0), (3, 0, 4, 0)]:
+            self.pd.send(" ".join(map(str, ("ctl", "pd-" + receive,
+                                            "connect") + connection)))
+        self._poolSwitch(index, False)
+        return newPatch, index
+
+    def _poolSwitch(self, index, on):
+        # turn the DSP of a pooled effect on or off; effects created outside
+        # the pool have no [switch~]
+        obj = self.patch.getObj(index)
+        if obj.name == "pd" and obj.args[0].startswith("pool-"):
+            self.pd.send("ctl {} {}".format(obj.args[0], int(on)))
+            return True
+        return False
+
+    def _runningReceives(self):
+        return {receive for channelEffects in self.effects
+                for patch, index in channelEffects.values()
+                for receive in patch.receives}
+
+    def _addEffect(self, name, channel, slot):
+        self.usage[name] += 1
+        if self._idle.get(name):
+            # already on the canvas, so bringing it up is just the rewiring
+            patch, index = self._idle[name].pop()
+            patch.channel = channel + 1
+            self._poolSwitch(index, True)
+            # It kept the control values it last ran with, so put them back
+            # to where a new instance would start. A receive another running
+            # effect also listens on is left alone, as sending to it would
+            # reset that effect too; this one has been following it anyway.
+            running = self._runningReceives()
+            for receive, control in patch.receives.items():
+                default = control.default()
+                if default is None or receive in running:
+                    continue
+                self.pd.send_control(receive,
+                                     "ctl {} {}".format(receive, default))
+                if self.controlValues.pop(receive, None) is not None:
+                    self._dirtyControls.add(receive)
+            return patch, index
+        return self._createEffect(name, channel, slot)
+
+    def _destroyEffect(self, index):
+        self.patch.removeObjectAt(index)
         # Reduce indices of all objects after the removed one
         for channelEffects in self.effects:
-            for name, eff in channelEffects.items():
-                if eff[1] >= index:
-                    channelEffects[name] = (eff[0], eff[1] - 1)
+            for effName, (effPatch, effIndex) in channelEffects.items():
+                if effIndex > index:
+                    channelEffects[effName] = (effPatch, effIndex - 1)
+        for instances in self._idle.values():
+            instances[:] = [(p, i - 1 if i > index else i)
+                            for p, i in instances]
+
+    def _removeEffect(self, name, channel):
+        # Returns True if the effect's object was deleted, not pooled.
+        patch, index = self.effects[channel].pop(name)
+        # a restarted effect comes back with its default control values,
+        # unless other running effects still share the receive
+        running = self._runningReceives()
+        for receive in patch.receives:
+            if receive not in running and \
+                    self.controlValues.pop(receive, None) is not None:
+                self._dirtyControls.add(receive)
+        idle = self._idle.setdefault(name, [])
+        if len(idle) < self._poolSizes.get(name, 0) and \
+                self._poolSwitch(index, False):
+            # back to the pool: unplug it and leave it on the canvas, off
+            obj = self.patch.getObj(index)
+            for position, toSocket in list(obj.outlets.items()):
+                self.patch.disconnect(pdgui.socket(index, position), toSocket)
+            for position, fromSocket in list(obj.inlets.items()):
+                self.patch.disconnect(fromSocket, pdgui.socket(index, position))
+            idle.append((patch, index))
+            return False
+        self._destroyEffect(index)
+        return True
+
+    @traced("patchbay")
+    @_locked
+    def resize_pool(self, sizes):
+        """Keep sizes[name] unconnected instances of each effect ready for
+        start_many to hand out, creating or destroying idle ones to match.
+        Effects not in sizes get no pool."""
+        self._settleSwaps()
+        with self.pd.batch():
+            for name in set(self._idle) | set(sizes):
+                idle = self._idle.setdefault(name, [])
+                self._poolSizes[name] = sizes.get(name, 0)
+                while len(idle) > self._poolSizes[name]:
+                    self._destroyEffect(idle.pop()[1])
+                while len(idle) < self._poolSizes[name]:
+                    idle.append(self._createPooled(
+                        name, sum(map(len, self._idle.values()))))
+
+    @_locked
+    def fit_pool(self, instances):
+        """Spread instances pooled effects over the effects started most
+        often so far, at most one per channel each."""
+        sizes = Counter()
+        ranked = [name for name, __ in self.usage.most_common()]
+        while ranked and sum(sizes.values()) < instances:
+            for name in list(ranked):
+                if sum(sizes.values()) == instances:
+                    break
+                sizes[name] += 1
+                if sizes[name] == len(self.effects):
+                    ranked.remove(name)
+        self.resize_pool(sizes)
+        return dict(sizes)
+
+    def dependencies(self, name):
+        """Abstraction files an effect needs, and the object names in it and
+        them that aren't abstractions (built-ins, externals, or missing)."""
+        patchFile = os.path.join(self.patchDir, name + ".pd")
+        files = sorted(self.resolver.closure(patchFile))
+        unresolved = set()
+        for f in [patchFile] + files:
+            unresolved.update(self.resolver.unresolved(f))
+        return files, sorted(unresolved)
+
+    @traced("patchbay")
+    @_locked
+    def reload(self, name):
+        """Update the models of running copies of an effect after its file
+        was edited. Returns the changes found."""
+        changes = []
+        for channelEffects in self.effects:
+            if name in channelEffects:
+                changes = channelEffects[name][0].update()
+                self._controlIndex = None
+        return changes
+
+    @traced("patchbay")
+    @_locked
+    def route_many(self, routes):
+        """Set the outputs each chain feeds, given as {input: outputs}, in
+        one batch. Only links that change are sent, and nothing is if any
+        input or output doesn't exist."""
+        for channel, outputs in routes.items():
+            if not 0 <= channel < len(self.effects):
+                raise IndexError("No input {}: inputs are 1 to {}".format(
+                    channel + 1, len(self.effects)))
+            for output in outputs:
+                if not 0 <= output < len(self.dacs):
+                    raise IndexError("No output {}: outputs are 1 to "
+                                     "{}".format(output + 1, len(self.dacs)))
+        with self.pd.batch():
+            for channel, outputs in routes.items():
+                outputs = set(outputs)
+                end = self.outs[channel]
+                for output in sorted(self.routes[channel] - outputs):
+                    self.pd.send("disconnect {} 0 {} 0".format(
+                        end, self.dacs[output]))
+                for output in sorted(outputs - self.routes[channel]):
+                    self.pd.send("connect {} 0 {} 0".format(
+                        end, self.dacs[output]))
+                self.routes[channel] = outputs
+                self._dirtyChannels.add(channel)
+
+    def route(self, channel, outputs):
+        self.route_many({channel: outputs})
+
+    def classIndex(self):
+        """Index of object classes and receive names in patchDir, brought
+        up to date with any patch files changed since it was last used."""
+        if self._classIndex is None:
+            self._classIndex = PdClassIndex(self.patchDir)
+            if os.path.exists(self._classIndex.path):
+                self._classIndex.load()
+        if self._classIndex.refresh():
+            self._classIndex.save()
+        return self._classIndex
+
+    def _mark(self, operation, names, channel):
+        # audio trouble Pd reports from now on gets blamed on this operation
+        self.pd.monitor.mark("{} {} on channel {}".format(
+            operation, " ".join(names), channel + 1))
+
+    def _checkBudget(self, names, channel):
+        if self.budget is None:
+            return
+        load = self.costs.projected(names)
+        if load > self.budget:
+            message = ("channel {} would use {:.1%} of a CPU core, over the "
+                       "{:.1%} budget".format(channel + 1, load, self.budget))
+            if self.strictBudget:
+                raise ValueError(message)
+            print("Warning:", message)
+
+    @traced("patchbay")
+    @_locked
+    def swap(self, oldName, newName, channel=0, fade=SWAP_FADE_MS):
+        """Replace a running effect with another in the same place without
+        a gap: the new one starts alongside the old, the output crossfades
+        over fade milliseconds, then the old one and the fader are removed.
+        Each step is one message batch of the same size whatever the
+        chain."""
+        self._settleSwaps()
+        channelEffects = self.effects[channel]
+        if oldName not in channelEffects or newName in channelEffects:
+            raise KeyError("Can't swap {} for {} on channel {}".format(
+                oldName, newName, channel + 1))
+        slot = list(channelEffects).index(oldName)
+        chain = self._chain(channel)
+        previous, oldIndex, following = chain[slot:slot + 3]
+        receive = "swap-{}".format(next(self._swapIds))
+        x, y = effectPosition(channel, slot)
+        self._mark("swap", [oldName, newName], channel)
+
+        def raw(*message):
+            self.pd.send(" ".join(map(str, message)))
+
+        with self.pd.batch():
+            newPatch, newIndex = self._addEffect(newName, channel, slot)
+            # The fader is a [pd swap-<n>] subpatch, so it goes with one
+            # find and cut, and nothing else on the canvas has its name.
+            # out = old + (new - old) * fader, with the fader going 0 to 1.
+            fader = self.patch.add([str(x + 120), str(y), "pd", receive])
+            for atoms in [(10, 10, "inlet~"), (60, 10, "inlet~"),
+                          (110, 10, "r", receive), (110, 30, "pack", "f", fade),
+                          (110, 50, "line~"), (10, 40, "-~"), (10, 70, "*~"),
+                          (10, 100, "+~"), (10, 130, "outlet~")]:
+                raw("ctl", "pd-" + receive, "obj", *atoms)
+            for connection in [(0, 0, 5, 0), (1, 0, 5, 1), (2, 0, 3, 0),
+                               (3, 0, 4, 0), (5, 0, 6, 0), (4, 0, 6, 1),
+                               (6, 0, 7, 0), (1, 0, 7, 1), (7, 0, 8, 0)]:
+                raw("ctl", "pd-" + receive, "connect", *connection)
+            # the model keeps the chain as it was until the fade is over
+            for connection in [(previous, 0, newIndex, 0),
+                               (newIndex, 0, fader, 0), (oldIndex, 0, fader, 1),
+                               (fader, 0, following, 0)]:
+                raw("connect", *connection)
+            raw("disconnect", oldIndex, 0, following, 0)
+            raw("ctl", receive, 1)
+            # only count the fade from when Pd has the fader, as an open
+            # batch() block holds the messages until it ends
+            applied = self.pd.send_acked([])
+        timer = threading.Timer(fade / 1000.0 * 2, self._settleSwaps)
+        timer.daemon = True
+        self._swaps.append((timer, channel, oldName, newName, newPatch,
+                            newIndex, fader))
+        # a timer cancelled by an earlier settle returns as soon as started
+        applied.add_done_callback(lambda future: timer.start())
+
+    def _settleSwaps(self):
+        # Remove the old effects and faders of swaps still in progress,
+        # leaving the new effects wired into their chains.
+        with self.lock:
+            swaps, self._swaps = self._swaps, []
+            if not swaps:
+                return
+            with PdTrace.span("settle swaps", "patchbay"), self.pd.batch():
+                for (timer, channel, oldName, newName, newPatch, newIndex,
+                     fader) in swaps:
+                    timer.cancel()
+                    channelEffects = self.effects[channel]
+                    slot = list(channelEffects).index(oldName)
+                    if newIndex > fader:
+                        newIndex -= 1
+                    self.patch.removeObjectAt(fader)
+                    oldIndex = channelEffects[oldName][1]
+                    # Pd already has the old effect's output unplugged
+                    following = self.patch.getObj(oldIndex).outlets.pop(0)
+                    self.patch.getObj(following.index).inlets.pop(
+                        following.position)
+                    if self._removeEffect(oldName, channel) and \
+                            newIndex > oldIndex:
+                        newIndex -= 1
+                    # and the new one's input plugged in, so the rewiring
+                    # below leaves that link alone
+                    previous = self._chain(channel)[slot]
+                    self.patch._connectSockets(pdgui.socket(previous, 0),
+                                               pdgui.socket(newIndex, 0))
+                    effects = list(channelEffects.items())
+                    effects.insert(slot, (newName, (newPatch, newIndex)))
+                    channelEffects.clear()
+                    channelEffects.update(effects)
+                    self._rewireChain(channel)
+
+    @_locked
+    def submit(self, operation, *args, **kwargs):
+        """Run operation (one of this bay's methods, or its name) and return
+        a Future resolving to what it returned once Pd has applied the edits
+        it sent, or raising PdEditError with what Pd complained about.
+
+        Nothing waits for Pd, so operations can be pipelined: submit
+        several, then wait on their futures. An operation raising here
+        gives an already failed Future."""
+        if isinstance(operation, str):
+            operation = getattr(self, operation)
+        try:
+            with self.pd.batch():
+                result = operation(*args, **kwargs)
+                return self.pd.fence(result)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+
+    def start(self, name, channel=0):
+        self.start_many([name], channel)
+
+    def stop(self, name, channel=0):
+        self.stop_many([name], channel)
+
+    @traced("patchbay")
+    @_locked
+    def start_many(self, names, channel=0):
+        """Append effects to the end of a channel's chain, rewiring it once."""
+        self._settleSwaps()
+        channelEffects = self.effects[channel]
+        self._checkBudget(list(channelEffects) +
+                          [n for n in names if n not in channelEffects],
+                          channel)
+        self._mark("start", names, channel)
+        with self.pd.batch():
+            for name in names:
+                if name not in channelEffects:
+                    channelEffects[name] = self._addEffect(
+                        name, channel, len(channelEffects))
+            self._rewireChain(channel)
+
+    @traced("patchbay")
+    @_locked
+    def stop_many(self, names, channel=0):
+        """Remove effects from a channel's chain, rewiring it once."""
+        self._settleSwaps()
+        self._mark("stop", names, channel)
+        with self.pd.batch():
+            for name in names:
+                if name in self.effects[channel]:
+                    self._removeEffect(name, channel)
+            self._rewireChain(channel)
+
+    @traced("patchbay")
+    @_locked
+    def replace_chain(self, names, channel=0):
+        """Make a channel's chain exactly the given effects in order, keeping
+        running effects that are still wanted."""
+        self._settleSwaps()
+        channelEffects = self.effects[channel]
+        self._checkBudget(list(dict.fromkeys(names)), channel)
+        self._mark("replace_chain", names, channel)
+        with self.pd.batch():
+            for name in [n for n in channelEffects if n not in names]:
+                self._removeEffect(name, channel)
+            chain = {}
+            for slot, name in enumerate(names):
+                if name in channelEffects:
+                    chain[name] = channelEffects[name]
+                elif name not in chain:
+                    chain[name] = self._addEffect(name, channel, slot)
+            channelEffects.clear()
+            channelEffects.update(chain)
+            self._rewireChain(channel)
+
+    @_locked
+    def controlIndex(self):
+        """Map of receive symbol to GUI control over all running effects."""
+        if self._controlIndex is None:
+            self._controlIndex = {}
+            for channelEffects in self.effects:
+                for patch, index in channelEffects.values():
+                    self._controlIndex.update(patch.receives)
+        return self._controlIndex
+
+    @traced("patchbay")
+    @_locked
+    def set_controls(self, values, scaled=False):
+        """Set many controls, given as {receive: value}, in one message batch.
+        Values are clamped to each control's range, or with scaled taken as
+        0-1 fractions of it."""
+        index = self.controlIndex()
+        missing = [r for r in values if r not in index]
+        if missing:
+            raise KeyError(
+                "No running controls receive on {}".format(", ".join(missing)))
+        with self.pd.batch():
+            for receive, value in values.items():
+                atom = index[receive].atom(value, scaled)
+                self.pd.send_control(receive,
+                                     "ctl {} {}".format(receive, atom))
+                self.controlValues[receive] = atom
+                self._dirtyControls.add(receive)
+
+    def set_control(self, receive, value, scaled=False):
+        self.set_controls({receive: value}, scaled)
+
+    @traced("patchbay")
+    @_locked
+    def snapshot(self, path):
+        """Save the running chains and control values to path.
+
+        The first snapshot to a path writes the whole state; later ones
+        append a line holding only what changed since. Returns whether
+        anything was written.
+        """
+        full = path != self._snapshotPath or not os.path.exists(path)
+        if full:
+            state = {
+                "channels": {str(c): list(e)
+                             for c, e in enumerate(self.effects)},
+                "routes": {str(c): sorted(r)
+                           for c, r in enumerate(self.routes)},
+                "controls": self.controlValues,
+            }
+        elif self._dirtyChannels or self._dirtyControls:
+            state = {
+                "channels": {str(c): list(self.effects[c])
+                             for c in sorted(self._dirtyChannels)},
+                "routes": {str(c): sorted(self.routes[c])
+                           for c in sorted(self._dirtyChannels)},
+                "controls": {r: self.controlValues.get(r)
+                             for r in sorted(self._dirtyControls)},
+            }
+        else:
+            return False
+        with open(path, "w" if full else "a") as snapshotFile:
+            snapshotFile.write(json.dumps(state, separators=(",", ":")))
+            snapshotFile.write("\n")
+        self._snapshotPath = path
+        self._dirtyChannels.clear()
+        self._dirtyControls.clear()
+        return True
+
+    @traced("patchbay")
+    @_locked
+    def restore(self, path):
+        """Bring the patch bay to the state saved in a snapshot file, in a
+        single batch of edits.
 
+        Entries that no longer fit (inputs, outputs or effect patches that
+        don't exist, controls nothing running receives) are left out, and
+        returned as a list of descriptions. Everything is checked before
+        any edit is sent."""
+        channels, routes, controls = {}, {}, {}
+        with open(path) as snapshotFile:
+            for line in snapshotFile:
+                if line.strip():
+                    state = json.loads(line)
+                    channels.update(state["channels"])
+                    routes.update(state.get("routes", {}))
+                    controls.update(state["controls"])
+        stale = []
+        chains, links = {}, {}
+        for channel, names in channels.items():
+            channel = int(channel)
+            if not 0 <= channel < len(self.effects):
+                stale.append("input {}".format(channel + 1))
+                continue
+            missing = [n for n in names if not os.path.exists(
+                os.path.join(self.patchDir,
+                             n if n.endswith(".pd") else n + ".pd"))]
+            stale.extend("effect {}".format(n) for n in missing)
+            chains[channel] = [n for n in names if n not in missing]
+        for channel, outputs in routes.items():
+            channel = int(channel)
+            if not 0 <= channel < len(self.effects):
+                if "input {}".format(channel + 1) not in stale:
+                    stale.append("input {}".format(channel + 1))
+                continue
+            links[channel] = [o for o in outputs
+                              if 0 <= o < len(self.dacs)]
+            stale.extend("output {}".format(o + 1) for o in outputs
+                         if o not in links[channel])
+        if self.strictBudget:
+            for channel, names in chains.items():
+                self._checkBudget(list(dict.fromkeys(names)), channel)
+        with self.pd.batch():
+            for channel, names in sorted(chains.items()):
+                self.replace_chain(names, channel)
+            self.route_many(links)
+            # the model already has the restored effects, so their controls
+            # are known before anything goes out
+            index = self.controlIndex()
+            stale.extend("control {}".format(r) for r in sorted(controls)
+                         if r not in index)
+            # controls may be held back for coalescing, so they're only
+            # queued once the effects they belong to have been
+            self.set_controls({r: v for r, v in controls.items()
+                               if v is not None and r in index})
+        self._snapshotPath = path
+        self._dirtyChannels.clear()
+        self._dirtyControls.clear()
+        return stale
+
+    @traced("patchbay")
+    @_locked
+    def compile(self, path, inline=(), prune=False):
+        """Write the running chains out as one patch Pd can open directly."""
+        with TemporaryDirectory(prefix="patchbay-") as workDir:
+            basePatch = os.path.join(workDir, INIT_PATCH)
+            ins, outs, dacs = writePatchBay(basePatch, len(self.effects),
+                                            len(self.dacs), self.routes)
+            compiler = ChainCompiler(basePatch, ins, outs, self.resolver)
+            return compiler.compile([list(e) for e in self.effects], path,
+                                    inline, prune)
+
+    @traced("patchbay")
+    def render(self, inFile, outFile, tail=0):
+        """Run inFile through the current chains into outFile offline, with
+        a separate batch mode Pd, leaving the live one alone. The patch bay
+        is only locked while the chains are read, not for the render."""
+        with self.lock:
+            chains = [list(e) for e in self.effects]
+        return pdrender.render(chains, inFile, outFile, self.patchDir, tail)
+
+    @_locked
     def stop_all(self):
-        for chan, channelEffects in enumerate(self.effects):
-            for patchName in list(channelEffects.keys()):
-                self.stop(patchName, chan)
+        with self.pd.batch():
+            for chan, channelEffects in enumerate(self.effects):
+                self.stop_many(list(channelEffects.keys()), chan)
 
     def shutdown(self):
         self.stop_all()
         self.pd.kill()
+        shutil.rmtree(os.path.dirname(self.basePatch), ignore_errors=True)
 
 
 class PatchWatcher(cmd.Cmd):
     """Stand-in interface for Pd patch handling."""
 
     prompt = os.linesep + "> "
+    # commands server clients run without holding the lock, as they take a
+    # long time and lock the patch bay themselves only where needed
+    unlockedCommands = frozenset(["render", "lint"])
     intro = textwrap.fill(
         "Pd patch watcher. No help right now.",
         subsequent_indent=" " * 4)
@@ -219,10 +995,72 @@ class PatchWatcher(cmd.Cmd):
     def __init__(self, **kw):
         cmd.Cmd.__init__(self)
         self.patchBay = PdPatchBay(**kw)
+        # serializes commands coming from concurrent server clients with
+        # each other and with the patch bay's own timers
+        self.lock = self.patchBay.lock
 
     def preloop(self):
         self.do_list(None)
 
+    def onecmd(self, line):
+        with PdTrace.span(line.split(" ", 1)[0] or "empty", "command",
+                          line=line):
+            return cmd.Cmd.onecmd(self, line)
+
+    def _runLine(self, line):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            return False
+        try:
+            return self.onecmd(self.precmd(line))
+        except Exception as e:
+            print("Error running {!r}: {}".format(line, e))
+            return False
+
+    def run_script(self, stream, batchLines=SCRIPT_BATCH_LINES):
+        """Run commands read from stream, piping the messages of each group of
+        batchLines commands to Pd in one go. Commands from a terminal, pipe
+        or socket run as each line arrives instead, as the next one may be a
+        long time coming. Returns True if the script quit."""
+        if not _isStored(stream):
+            batchLines = 1
+        lines = iter(stream)
+        while True:
+            chunk = list(islice(lines, batchLines))
+            if not chunk:
+                return False
+            with self.patchBay.pd.batch():
+                for line in chunk:
+                    if self._runLine(line):
+                        return True
+
+    def serve(self, address):
+        """Accept commands, one per line, from any number of clients over
+        TCP ("host:port") or a Unix socket (a filesystem path)."""
+        host, sep, port = address.rpartition(":")
+        unixPath = None
+        if sep and port.isdigit():
+            server = _ThreadingTCPServer((host or "127.0.0.1", int(port)),
+                                         _CommandHandler)
+        else:
+            unixPath = address
+            if (os.path.exists(address) and
+                    stat.S_ISSOCK(os.stat(address).st_mode)):
+                os.unlink(address)
+            server = _ThreadingUnixServer(address, _CommandHandler)
+        server.shell = self
+        print("Serving patch bay commands on", address)
+        server.output = sys.stdout = _ThreadOutput(sys.stdout)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sys.stdout = server.output.default
+            server.server_close()
+            if unixPath:
+                os.unlink(unixPath)
+
     def do_list(self, __):
         print("Available patches:")
         print(os.linesep.join(
@@ -280,6 +1118,238 @@ class PatchWatcher(cmd.Cmd):
 
     do_kill = do_stop
 
+    def do_deps(self, line):
+        """deps <patch>
+        List the abstraction files a patch depends on."""
+        files, unresolved = self.patchBay.dependencies(
+            self._patchName(line.strip()))
+        print(os.linesep.join(files) or "No abstractions used.")
+        if unresolved:
+            print(textwrap.fill("Not abstractions: " + " ".join(unresolved),
+                                subsequent_indent=" " * 4))
+
+    def do_compile(self, line):
+        """compile <file> [prune] [all | <patch to inline> ...]
+        Write the running chains to one patch file, optionally copying
+        abstractions in and dropping objects that do nothing."""
+        parts = line.split()
+        path = parts.pop(0)
+        prune = "prune" in parts
+        inline = [self._patchName(p) for p in parts if p != "prune"]
+        if inline == ["all~"]:
+            inline = True
+        self.patchBay.compile(path, inline, prune)
+        print("Wrote", path)
+
+    def do_render(self, line):
+        """render <input file> <output file> [<tail ms>]
+        Run a sound file through the current chains into another file, as
+        fast as the CPU allows."""
+        parts = line.split()
+        tail = float(parts[2]) if len(parts) > 2 else 0
+        try:
+            status = self.patchBay.render(parts[0], parts[1], tail)
+        except (OSError, PdException) as e:
+            print("Can't render:", e)
+            return
+        if status == 0:
+            print("Wrote", parts[1])
+        else:
+            print("Pd exited with status", status)
+
+    def do_costs(self, __):
+        """costs
+        Show the measured CPU cost of each effect and of each channel."""
+        costs = self.patchBay.costs
+        for name in sorted(os.path.splitext(p)[0]
+                           for p in self.patchBay.availPatches):
+            cost = costs.cost(name)
+            print("{:<24} {}".format(
+                name, "not profiled" if cost is None
+                else "{:.2%}".format(cost)))
+        for channel, channelEffects in enumerate(self.patchBay.effects):
+            print("Channel {}: {:.2%}".format(
+                channel + 1, costs.projected(channelEffects)))
+
+    def do_record(self, line):
+        """record <file> | record stop
+        Log every message sent to Pd, with timestamps, for pdreplay.py."""
+        path = line.strip()
+        if path == "stop":
+            self.patchBay.pd.stop_recording()
+        else:
+            self.patchBay.pd.record(path)
+            print("Recording to", path)
+
+    def do_lint(self, line):
+        """lint [<patch> ...]
+        Look for patterns that waste DSP time in the given patches, or in
+        all of them."""
+        names = [self._patchName(t) for t in line.split()]
+        findings = pdlint.lintLibrary(
+            pdlint.patchFiles(self.patchBay.patchDir, names))
+        print(os.linesep.join(map(str, findings)) or "Nothing found.")
+
+    def do_reload(self, line):
+        """reload <patch>
+        Pick up edits to a running patch's file and show what changed."""
+        changes = self.patchBay.reload(self._patchName(line.strip()))
+        for change in changes:
+            print("{:<10} {:<14} {}".format(change.kind, str(change.index),
+                                            change.element))
+        if not changes:
+            print("No changes.")
+
+    def _printLocations(self, found):
+        for filename, where in sorted(found.items()):
+            print("{:<24} {}".format(
+                os.path.basename(filename),
+                " ".join("{}:{}".format(c, i) for c, i in where)))
+
+    def do_uses(self, line):
+        """uses <class>
+        List the patches, canvases and object numbers using an object
+        class or abstraction."""
+        found = self.patchBay.classIndex().uses(line.strip())
+        if not found:
+            print("No patch uses", line.strip())
+        self._printLocations(found)
+
+    def do_receivers(self, line):
+        """receivers <name>
+        List the [r]s, [r~]s, [catch~]es and GUI controls listening on a
+        receive name."""
+        found = self.patchBay.classIndex().receivers(line.strip())
+        if not found:
+            print("Nothing receives", line.strip())
+        self._printLocations(found)
+
+    def do_trace(self, line):
+        """trace start | trace stop <file>
+        Record a timeline of commands, patch bay operations, parsing and
+        messages to Pd, saved for chrome://tracing or Perfetto."""
+        parts = line.split()
+        if parts[:1] == ["start"]:
+            PdTrace.start()
+        elif parts[:1] == ["stop"] and len(parts) == 2:
+            PdTrace.stop(parts[1])
+            print("Wrote", parts[1])
+        else:
+            print("Usage: trace start | trace stop <file>")
+
+    def do_sync(self, line):
+        """sync [<seconds>]
+        Wait until Pd has applied everything sent so far, and show what it
+        complained about meanwhile."""
+        timeout = float(line) if line.strip() else SYNC_TIMEOUT
+        try:
+            self.patchBay.pd.fence().result(timeout)
+            print("OK")
+        except PdEditError as e:
+            for error in e.errors:
+                print("pd:", error)
+        except FutureTimeout:
+            print("Pd hasn't caught up after", timeout, "seconds")
+
+    def do_xruns(self, __):
+        """xruns
+        Show audio dropouts Pd reported and what was done just before."""
+        monitor = self.patchBay.pd.monitor
+        if not monitor.counts:
+            print("No audio trouble reported.")
+            return
+        for kind, count in monitor.counts.most_common():
+            print("{:<12} {}".format(kind, count))
+        print("After:")
+        for operation, count in monitor.byOperation().most_common():
+            print("{:>5}  {}".format(count, operation or "startup"))
+
+    def do_set(self, line):
+        """set <receive> <value> [<receive> <value> ...]
+        Set running controls by receive name, clamped to their ranges."""
+        parts = line.split()
+        self.patchBay.set_controls(dict(zip(parts[::2], parts[1::2])))
+
+    def do_set_scaled(self, line):
+        """set_scaled <receive> <fraction> [<receive> <fraction> ...]
+        Set running controls to 0-1 fractions of their ranges."""
+        parts = line.split()
+        self.patchBay.set_controls(dict(zip(parts[::2], parts[1::2])),
+                                   scaled=True)
+
+    def do_snapshot(self, line):
+        """snapshot <file>
+        Save running patches and control values, appending only changes
+        when the file was the last one snapshotted to."""
+        if not self.patchBay.snapshot(line.strip()):
+            print("Nothing changed since the last snapshot.")
+
+    def do_restore(self, line):
+        """restore <file>
+        Restore running patches and control values from a snapshot."""
+        stale = self.patchBay.restore(line.strip())
+        if stale:
+            print("Left out, as they no longer exist:", ", ".join(stale))
+
+    def _patchName(self, token):
+        if token.isdigit():
+            return os.path.splitext(
+                self.patchBay.availPatches[int(token) - 1])[0]
+        return token if token.endswith("~") else token + "~"
+
+    def _parseChannelAndNames(self, line):
+        parts = line.strip().split()
+        channel = int(parts.pop(0)) - 1
+        return channel, [self._patchName(p) for p in parts]
+
+    def do_pool(self, line):
+        """pool [<instances> | <patch> <count> [<patch> <count> ...]]
+        Show the pool of ready effect instances, size it to the most used
+        effects, or set it per effect."""
+        parts = line.split()
+        if len(parts) == 1:
+            print(self.patchBay.fit_pool(int(parts[0])))
+        elif parts:
+            self.patchBay.resize_pool(
+                {self._patchName(n): int(c)
+                 for n, c in zip(parts[::2], parts[1::2])})
+        for name, instances in sorted(self.patchBay._idle.items()):
+            print("{:<24} {} idle, started {} times".format(
+                name, len(instances), self.patchBay.usage[name]))
+
+    def do_route(self, line):
+        """route <channel> [<output> ...]
+        Send a channel's chain to the given outputs (none to mute it)."""
+        parts = [int(p) - 1 for p in line.split()]
+        self.patchBay.route(parts[0], parts[1:])
+
+    def do_swap(self, line):
+        """swap <channel> <running patch> <new patch> [<fade ms>]
+        Replace a running patch by crossfading to another in its place."""
+        parts = line.split()
+        channel = int(parts[0]) - 1
+        fade = float(parts[3]) if len(parts) > 3 else SWAP_FADE_MS
+        self.patchBay.swap(self._patchName(parts[1]),
+                           self._patchName(parts[2]), channel, fade)
+
+    def do_start_many(self, line):
+        """start_many <channel> <patch> [<patch> ...]
+        Append several patches to a channel's chain at once."""
+        channel, names = self._parseChannelAndNames(line)
+        self.patchBay.start_many(names, channel)
+
+    def do_stop_many(self, line):
+        """stop_many <channel> <patch> [<patch> ...]
+        Remove several patches from a channel's chain at once."""
+        channel, names = self._parseChannelAndNames(line)
+        self.patchBay.stop_many(names, channel)
+
+    def do_replace_chain(self, line):
+        """replace_chain <channel> [<patch> ...]
+        Replace a channel's whole chain with the given patches, in order."""
+        channel, names = self._parseChannelAndNames(line)
+        self.patchBay.replace_chain(names, channel)
+
     def do_quit(self, __):
         self.do_stop(Ellipsis)
         print("OK. Bye!")
@@ -288,6 +1358,71 @@ class PatchWatcher(cmd.Cmd):
     do_exit = do_quit
 
 
+class _ThreadOutput(io.TextIOBase):
+    # Stands in for sys.stdout while serving, so each client handler can
+    # collect what its own command prints while every other thread (Pd's
+    # stderr reader, timers, other clients) still prints to the terminal.
+    def __init__(self, default):
+        self.default = default
+        self._local = threading.local()
+
+    def _stream(self):
+        return getattr(self._local, "stream", None) or self.default
+
+    def write(self, text):
+        return self._stream().write(text)
+
+    def flush(self):
+        self._stream().flush()
+
+    @contextmanager
+    def capture(self, stream):
+        self._local.stream = stream
+        try:
+            yield
+        finally:
+            self._local.stream = None
+
+
+def _isStored(stream):
+    # whether all of stream can be read without waiting on someone, as with
+    # a file on disk or an in-memory buffer
+    try:
+        return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return True
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        shell = self.server.shell
+        for raw in self.rfile:
+            line = raw.decode("utf-8", "replace").strip()
+            if line in ("quit", "exit", "EOF"):
+                # only ends this client's session, the patch bay keeps running
+                break
+            out = io.StringIO()
+            lock = (nullcontext() if line.split(" ", 1)[0] in
+                    shell.unlockedCommands else shell.lock)
+            with lock, self.server.output.capture(out), \
+                    shell.patchBay.pd.batch():
+                shell._runLine(line)
+            self.wfile.write(out.getvalue().encode("utf-8"))
+            self.wfile.flush()
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class _ThreadingUnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+else:
+    _ThreadingUnixServer = None
+
+
 def setupParser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--gui", action="store_false", dest="nogui",
@@ -295,15 +1430,120 @@ def setupParser():
                         help="Start Pd with a gui.")
     parser.add_argument("--dir", dest="patchDir", default=PATCH_DIR,
                         help="Specify a different default patch directory.")
+    parser.add_argument("--control-window", dest="controlWindow", type=float,
+                        default=DEFAULT_WINDOW,
+                        help="Seconds control changes wait to be merged with "
+                             "newer values for the same control (0 to send "
+                             "each one right away).")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--script", type=argparse.FileType("r"), default=None,
+                      help="Run commands from a file ('-' for stdin) "
+                           "instead of interactively.")
+    mode.add_argument("--serve", metavar="ADDRESS", default=None,
+                      help="Accept commands from clients on host:port or "
+                           "on a Unix socket path.")
+    mode.add_argument("--render", nargs=2, metavar=("IN", "OUT"),
+                      default=None,
+                      help="Render sound file IN through the --chain effects "
+                           "into OUT offline, without a sound card, and exit.")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="Fraction of a CPU core each channel's effects "
+                             "may use; starting more warns.")
+    parser.add_argument("--strict-budget", dest="strictBudget",
+                        action="store_true",
+                        help="Refuse to start effects over the --budget.")
+    parser.add_argument("--inputs", type=int, default=2,
+                        help="Number of audio inputs, each with its own "
+                             "effect chain.")
+    parser.add_argument("--outputs", type=int, default=None,
+                        help="Number of audio outputs (default: as many as "
+                             "inputs).")
+    parser.add_argument("--trace", metavar="FILE", default=None,
+                        help="Record a timeline of everything done to FILE "
+                             "as Chrome trace event JSON.")
+    parser.add_argument("--pool", metavar="PATCH:COUNT", nargs="+",
+                        default=None,
+                        help="Create COUNT idle instances of each PATCH at "
+                             "startup so starting them doesn't allocate.")
+    parser.add_argument("--chain", action="append", default=[],
+                        metavar="PATCHES",
+                        help="Space separated effects for --render, once per "
+                             "channel in order.")
+    parser.add_argument("--tail", type=float, default=0,
+                        help="Milliseconds to keep rendering after the input "
+                             "ends.")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    lint = commands.add_parser(
+        "lint", help="Check the given patches (all of them if none are "
+                     "given) for DSP cost problems and exit.")
+    lint.add_argument("patches", nargs="*", metavar="PATCH")
+    profile = commands.add_parser(
+        "profile", help="Measure the CPU cost of the given effects (all of "
+                        "them if none are given) offline, save it to the "
+                        "cost database and exit.")
+    profile.add_argument("patches", nargs="*", metavar="PATCH")
+    profile.add_argument("--seconds", type=float, default=PROFILE_SECONDS,
+                         help="Seconds of audio to run each effect for.")
     return parser
 
 
 def main(argv=None):
     parser = setupParser()
-    args = parser.parse_args()
-    patchShell = PatchWatcher(**vars(args))
+    args = vars(parser.parse_args(argv))
+    script, serve = args.pop("script"), args.pop("serve")
+    render, chains, tail = args.pop("render"), args.pop("chain"), \
+        args.pop("tail")
+    command, patches = args.pop("command"), args.pop("patches", [])
+    if command == "lint":
+        findings = pdlint.lintLibrary(
+            pdlint.patchFiles(args["patchDir"], patches))
+        for finding in findings:
+            print(finding)
+        return int(any(f.severity == pdlint.ERROR for f in findings))
+    if command == "profile":
+        names = [n if n.endswith("~") else n + "~" for n in patches]
+        costs = PdCostDb(args["patchDir"])
+        costs.profile(names or sorted(
+            os.path.splitext(p)[0] for p in os.listdir(args["patchDir"])
+            if os.path.splitext(p)[0].endswith("~")), args["seconds"])
+        for name in sorted(costs.entries):
+            print("{:<24} {:.2%}".format(name, costs.entries[name]["cost"]))
+        return 0
+    if render:
+        chains = [[n if n.endswith("~") else n + "~" for n in c.split()]
+                  for c in chains]
+        try:
+            return pdrender.render(chains, render[0], render[1],
+                                   args["patchDir"], tail)
+        except (OSError, PdException) as e:
+            print("Can't render:", e, file=sys.stderr)
+            return 1
+    if serve and ":" not in serve and _ThreadingUnixServer is None:
+        parser.error("Unix sockets are not supported on this platform.")
+    if args["pool"]:
+        args["pool"] = {
+            (n if n.endswith("~") else n + "~"): int(c)
+            for n, c in (p.rsplit(":", 1) for p in args["pool"])}
+    trace = args.pop("trace")
+    if trace:
+        PdTrace.start()
     try:
-        patchShell.cmdloop()
+        _runShell(PatchWatcher(**args), script, serve)
+    finally:
+        if trace:
+            PdTrace.stop(trace)
+
+
+def _runShell(patchShell, script, serve):
+    try:
+        if script:
+            if not patchShell.run_script(script):
+                patchShell.do_quit(Ellipsis)
+        elif serve:
+            patchShell.serve(serve)
+            patchShell.do_quit(Ellipsis)
+        else:
+            patchShell.cmdloop()
     except:
         patchShell.do_quit(Ellipsis)
         raise
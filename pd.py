@@ -1,9 +1,17 @@
 import os
 import signal
 import sys
+import threading
 import time
+from contextlib import contextmanager
 from subprocess import Popen, PIPE
 
+from pypd.PdAcks import PdAcks
+from pypd.PdCoalescer import PdCoalescer, DEFAULT_WINDOW, DEFAULT_MAXLEN
+from pypd.PdMonitor import PdDspMonitor
+from pypd.PdRecorder import PdRecorder, OUT
+from pypd.PdTrace import span, instant
+
 DEFAULT_PORT = 3000
 
 
@@ -31,12 +39,29 @@ class pd(object):
         else:
             return pdbin
 
-    def __init__(self, stderr=True, nogui=True, initPatch=None, bin=None):
+    def __init__(self, stderr=True, nogui=True, initPatch=None, bin=None,
+                 controlWindow=DEFAULT_WINDOW, controlQueue=DEFAULT_MAXLEN,
+                 offline=False, path=(), rate=None, inchannels=None,
+                 outchannels=None):
+        # offline runs Pd in -batch mode: no audio device, DSP computed as
+        # fast as the CPU allows until the patch sends "pd quit"
         self.pdbin = pd._getPdBin(bin)
         args = [self.pdbin]
 
         self.pdsend = os.path.join(os.path.dirname(self.pdbin), "pdsend")
         self.port = DEFAULT_PORT
+        # per thread, messages queued by an open batch() block
+        self._local = threading.local()
+        # one pdsend at a time, whichever thread it's from
+        self._sendLock = threading.Lock()
+        # a PdRecorder logging everything sent, if any
+        self.recorder = None
+        # sends waiting for patchbay.pd to echo their sequence number
+        self.acks = PdAcks()
+        # control messages wait here for newer values of the same target
+        self.controls = (PdCoalescer(self._sendControls, controlWindow,
+                                     controlQueue)
+                         if controlWindow else None)
 
         if stderr:
             args.append("-stderr")
@@ -44,6 +69,21 @@ class pd(object):
         if nogui:
             args.append("-nogui")
 
+        if offline:
+            args.append("-batch")
+
+        if rate:
+            args.extend(["-r", str(rate)])
+
+        if inchannels:
+            args.extend(["-inchannels", str(inchannels)])
+
+        if outchannels:
+            args.extend(["-outchannels", str(outchannels)])
+
+        for directory in path:
+            args.extend(["-path", directory])
+
         if initPatch:
             args.append("-open")
             args.append(initPatch)
@@ -57,15 +97,138 @@ class pd(object):
                 "Problem running `{}` from '{}'".format(self.pdbin,
                                                         os.getcwd()))
 
+        # Pd blocks once the stderr pipe fills up, so keep draining it
+        self.monitor = PdDspMonitor()
+        self._stderrReader = threading.Thread(target=self._readStderr)
+        self._stderrReader.daemon = True
+        self._stderrReader.start()
+
+    def _readStderr(self):
+        for line in iter(self.proc.stderr.readline, b""):
+            line = line.decode("utf-8", "replace").rstrip()
+            if line and not self.acks.feed(line) and \
+                    not self.monitor.feed(line):
+                print("pd:", line)
+        self.acks.fail(PdException("Pd exited before applying the edits"))
+
+    @property
+    def _batch(self):
+        # this thread's open batch() block's messages, None outside of one
+        return getattr(self._local, "batch", None)
+
+    @_batch.setter
+    def _batch(self, msgs):
+        self._local.batch = msgs
+
     def send(self, msg):
-        args = [self.pdsend, str(DEFAULT_PORT)]
-        print(args, msg)
-        msg = "; " + msg + ";"
-        sendProc = Popen(args, stdin=PIPE, close_fds=(sys.platform != "win32"),
-                         universal_newlines=True)
-        out, err = sendProc.communicate(input=msg)
+        instant("send", "pd", message=msg)
+        if self._batch is not None:
+            self._batch.append(msg)
+        else:
+            self.send_many([msg])
+
+    def send_many(self, msgs):
+        if not msgs:
+            return
+        args = [self.pdsend, str(self.port)]
+        payload = "".join("; " + msg + ";" + os.linesep for msg in msgs)
+        if self.recorder:
+            for msg in msgs:
+                self.recorder.record(
+                    OUT, ("; " + msg + ";" + os.linesep).encode("utf-8"))
+        with self._sendLock, span("pdsend", "pd", messages=len(msgs)):
+            with span("spawn", "pd"):
+                sendProc = Popen(args, stdin=PIPE,
+                                 close_fds=(sys.platform != "win32"),
+                                 universal_newlines=True)
+            out, err = sendProc.communicate(input=payload)
+
+    def _sendControls(self, msgs):
+        # The coalescer's batches join this thread's open batch() block, if
+        # there is one, so they keep their place before what's sent later.
+        if self._batch is not None:
+            self._batch.extend(msgs)
+        else:
+            self.send_many(msgs)
+
+    def send_acked(self, msgs, value=None):
+        # Send msgs (one message or a list) after any control messages the
+        # coalescer is holding back, followed by "ack <n>". Returns a
+        # Future resolving to value once Pd has applied them, or raising
+        # PdEditError with what Pd complained about meanwhile. Nothing waits
+        # for it, so many can be in flight at once; inside a batch() block
+        # the ack goes out with the rest of the batch.
+        if self.controls is not None:
+            # controls still waiting were set before this, so go before the
+            # ack, and any errors they cause are charged to it
+            self.controls.flush()
+        sequence, future = self.acks.next(value)
+        msgs = [msgs] if isinstance(msgs, str) else list(msgs)
+        msgs.append("ack {}".format(sequence))
+        if self._batch is not None:
+            self._batch.extend(msgs)
+        else:
+            self.send_many(msgs)
+        return future
+
+    def fence(self, value=None):
+        # A Future for everything sent so far having been applied. Messages
+        # an open batch() block queued go out now along with the ack, so
+        # it can be waited on inside one.
+        future = self.send_acked([], value)
+        self._flushBatch()
+        return future
+
+    def _flushBatch(self):
+        # send what this thread's open batch() block has queued so far
+        if self._batch:
+            msgs, self._batch[:] = list(self._batch), []
+            self.send_many(msgs)
+
+    def send_control(self, target, msg):
+        # Unlike send(), a message that hasn't gone out yet is dropped when
+        # a newer one for the same target comes along.
+        if self.controls is None:
+            self.send(msg)
+        else:
+            self.controls.push(target, msg)
+
+    @contextmanager
+    def batch(self):
+        # Queue everything sent inside the block and pipe it through a single
+        # pdsend process when the outermost block exits.
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        finally:
+            msgs, self._batch = self._batch, None
+            self.send_many(msgs)
+
+    def record(self, out):
+        # Log every message sent from now on, as pdsend delivers it to
+        # [netreceive], to out (a filename or binary file).
+        self.stop_recording()
+        self.recorder = PdRecorder(out)
+        return self.recorder
+
+    def stop_recording(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def wait(self, timeout=None):
+        return self.proc.wait(timeout)
 
     def kill(self):
+        if self.controls is not None:
+            self.controls.flush()
+        # edits queued in an open batch() block, like a quitting script's
+        # last stops, go out before Pd does
+        self._flushBatch()
+        self.stop_recording()
         self.proc.send_signal(signal.SIGINT)
         if self.proc:
             self.proc.wait()
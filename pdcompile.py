@@ -0,0 +1,172 @@
+import os
+from itertools import count
+
+from pypd.PdAcks import ACK_PRINT
+from pypd.PdCanvas import PdCanvas
+from pypd.PdResolver import PdResolver
+from pypd.PdWriter import PdWriter
+from pd import DEFAULT_PORT
+
+
+def effectPosition(channel, slot):
+    return 40 + 275 * channel, 80 + 40 * (slot + 1)
+
+
+def writePatchBay(path, inputs=2, outputs=2, routes=None, port=DEFAULT_PORT):
+    r"""Write the patch the patch bay runs in Pd: [netreceive] for edits,
+    "ctl <receive> <message>" to pass message on to a receive name (a
+    control value, or an edit for a subpatch through its "pd-<name>"),
+    "ack <n>"s to echo on stderr once everything before them is done, an
+    [adc~] and a chain end for each input, and a [dac~] for each output.
+    routes[input] are the outputs that input's chain feeds, input n to
+    output n by default. The file must be called patchbay.pd for edits to
+    reach it.
+
+    Returns the object numbers of the [adc~]s, chain ends and [dac~]s.
+
+    [route] hands "ctl vol 0.5" on as "vol 0.5", with vol as the selector,
+    which [list] keeps as the first atom of "list vol 0.5". [list split 1]s
+    then set [send]'s target to vol and send it the rest, "0.5"; [trigger]
+    fires right to left, so the target is set first.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "patchbay.pd")
+    >>> writePatchBay(path, 1, 1)
+    ([12], [13], [14])
+    >>> print("".join(open(path).readlines()[5:13]).strip())
+    #X obj 10 35 route ctl ack;
+    #X obj 10 60 list;
+    #X obj 10 85 t a a;
+    #X obj 60 110 list split 1;
+    #X obj 10 110 list split 1;
+    #X obj 10 135 list trim;
+    #X obj 10 160 send;
+    #X obj 220 60 print patchbay-ack;
+    >>> print("".join(l for l in open(path) if l.split()[2:3] in
+    ...     [["4"], ["5"], ["6"], ["7"], ["8"], ["9"]]).strip())
+    #X connect 4 0 5 0;
+    #X connect 5 0 6 0;
+    #X connect 6 1 7 0;
+    #X connect 7 0 10 1;
+    #X connect 6 0 8 0;
+    #X connect 8 1 9 0;
+    #X connect 9 0 10 0;
+    #X connect 4 1 11 0;
+    #X connect 4 2 1 0;
+    """
+    if routes is None:
+        routes = [{c} if c < outputs else set() for c in range(inputs)]
+    with open(path, "w") as patchFile:
+        w = PdWriter(patchFile)
+        w.canvas(100, 100, 40 + 275 * max(inputs, outputs), 420)
+        netreceive = w.obj(10, 10, "netreceive", port)
+        canvas = w.obj(100, 60, "s", "pd-patchbay.pd")
+        loadbang = w.obj(220, 10, "loadbang")
+        dsp = w.msg(220, 32, ";", "pd", "dsp", 1)
+        route = w.obj(10, 35, "route", "ctl", "ack")
+        selector = w.obj(10, 60, "list")
+        tee = w.obj(10, 85, "t", "a", "a")
+        target = w.obj(60, 110, "list", "split", 1)
+        message = w.obj(10, 110, "list", "split", 1)
+        trim = w.obj(10, 135, "list", "trim")
+        send = w.obj(10, 160, "send")
+        ack = w.obj(220, 60, "print", ACK_PRINT)
+        ins = [w.obj(40 + 275 * c, 80, "adc~", c + 1) for c in range(inputs)]
+        ends = [w.obj(40 + 275 * c, 340, "*~", 1) for c in range(inputs)]
+        dacs = [w.obj(40 + 275 * c, 380, "dac~", c + 1)
+                for c in range(outputs)]
+        w.connect(netreceive, 0, route, 0)
+        w.connect(route, 0, selector, 0)
+        w.connect(selector, 0, tee, 0)
+        w.connect(tee, 1, target, 0)
+        w.connect(target, 0, send, 1)
+        w.connect(tee, 0, message, 0)
+        w.connect(message, 1, trim, 0)
+        w.connect(trim, 0, send, 0)
+        w.connect(route, 1, ack, 0)
+        w.connect(route, 2, canvas, 0)
+        w.connect(loadbang, 0, dsp, 0)
+        for c in range(inputs):
+            w.connect(ins[c], 0, ends[c], 0)
+            for output in sorted(routes[c]):
+                w.connect(ends[c], 0, dacs[output], 0)
+    return ins, ends, dacs
+
+
+class ChainCompiler(object):
+    """Flatten effect chains on top of a base patch into one .pd file."""
+
+    def __init__(self, basePatch, ins, outs, resolver=None):
+        self.basePatch = basePatch
+        self.ins, self.outs = ins, outs
+        self.resolver = resolver or PdResolver()
+
+    def _inlineWithin(self, canvas, fromFile, inline, seen, suffixes):
+        for sub in canvas.subpatches():
+            self._inlineWithin(sub, fromFile, inline, seen, suffixes)
+        for n, position in enumerate(canvas.objects):
+            element = canvas.elements[position]
+            if isinstance(element, PdCanvas) or element[1] != "obj":
+                continue
+            name = canvas.name(n)
+            if inline is not True and name not in inline:
+                continue
+            abstraction = self.resolver.find(name, fromFile)
+            if abstraction is None or abstraction in seen:
+                continue
+            x, y = element[2].split()[:2]
+            canvas.elements[position] = self._abstraction(
+                abstraction, name, element[2].split()[3:], x, y, inline,
+                seen, suffixes)
+
+    def _abstraction(self, abstraction, name, args, x, y, inline, seen,
+                     suffixes):
+        sub = PdCanvas.load(abstraction)
+        # the top level header is "x y width height font", a subpatch's is
+        # "x y width height name vis"
+        sub.header = " ".join(sub.header.split()[:4] + [name, "0"])
+        sub.restore = " ".join([x, y, "pd", name])
+        sub.substitute(args, str(next(suffixes)))
+        self._inlineWithin(sub, abstraction, inline, seen | {abstraction},
+                           suffixes)
+        return sub
+
+    def compile(self, chains, outPath, inline=(), prune=False):
+        """Write the base patch with chains[channel] (effect names, in order)
+        wired between each channel's input and output to outPath.
+
+        inline names abstractions to copy in as subpatches instead of
+        loading them by name, or is True to inline all of them. With prune,
+        objects left without connections that do nothing are dropped.
+        """
+        base = PdCanvas.load(self.basePatch)
+        suffixes = count(1)
+        for channel, names in enumerate(chains):
+            previous = self.ins[channel]
+            base.disconnect(previous, 0, self.outs[channel], 0)
+            for slot, name in enumerate(names):
+                x, y = map(str, effectPosition(channel, slot))
+                element = ("#X", "obj", " ".join([x, y, name]))
+                if inline is True or name in inline:
+                    abstraction = self.resolver.find(name, self.basePatch)
+                    if abstraction is not None:
+                        element = self._abstraction(
+                            abstraction, name, [], x, y, inline,
+                            {abstraction}, suffixes)
+                index = base.add(element)
+                base.connect(previous, 0, index, 0)
+                previous = index
+            base.connect(previous, 0, self.outs[channel], 0)
+        if prune:
+            base.prune()
+        with open(outPath, "w") as outFile:
+            base.write(PdWriter(outFile))
+        return outPath
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -43,6 +43,46 @@ class PdGui(PdObject):
         "nbx",   # number box
     ]
 
+    def addressable(self):
+        """Whether messages can reach this control through its receive name.
+        $0-local names are unique per instance and can't be sent to."""
+        receive = getattr(self, "receive", "empty")
+        return receive != "empty" and "$" not in receive
+
+    def range(self):
+        """(low, high, logarithmic) for the values this control takes, or
+        None if it doesn't take a value."""
+        return None
+
+    def default(self):
+        """The atom this control holds when its patch is created, or None if
+        it doesn't hold a value.
+
+        >>> hsl("0 0 hsl 128 15 0 10 0 1 empty vol empty -2 -8 0 10 -262144 "
+        ...     "-1 -1 6350 1".split()).default()
+        '5'
+        >>> hsl("0 0 hsl 128 15 0 10 0 0 empty vol empty -2 -8 0 10 -262144 "
+        ...     "-1 -1 6350 1".split()).default()
+        '0'
+        >>> bng("0 0 bng 15 250 50 0 empty b empty 17 7 0 10 -262144 -1 "
+        ...     "-1".split()).default()
+        """
+        return None
+
+    def atom(self, value, scaled=False):
+        """The atom to send this control for value, clamped to its range.
+        If scaled, value is a 0-1 fraction of the range instead."""
+        low, high, log = self.range()
+        value = float(value)
+        if scaled:
+            fraction = min(max(value, 0.0), 1.0)
+            if log and low > 0:
+                value = low * (high / low) ** fraction
+            else:
+                value = low + (high - low) * fraction
+        value = min(max(value, min(low, high)), max(low, high))
+        return "{:.7g}".format(value)
+
 
 class bng(PdGui):
     args = PdObject.args + [
@@ -62,6 +102,9 @@ class bng(PdGui):
         "label_color",  # label color
     ]
 
+    def atom(self, value, scaled=False):
+        return "bang"
+
 
 class tgl(PdGui):
     args = PdObject.args + [
@@ -81,6 +124,14 @@ class tgl(PdGui):
         "default_value",  # default value when the [init] attribute is not set
     ]
 
+    def range(self):
+        return 0.0, float(getattr(self, "default_value", 1)) or 1.0, False
+
+    def default(self):
+        if getattr(self, "init", "0") == "0":
+            return self.atom(0)
+        return self.atom(getattr(self, "init_value", 0))
+
 
 class nbx(PdGui):
     args = [
@@ -107,6 +158,14 @@ class nbx(PdGui):
         "log_height",  # log steps: values from 10 to 2000, default is 256
     ]
 
+    def range(self):
+        return float(self.min), float(self.max), self.log != "0"
+
+    def default(self):
+        if getattr(self, "init", "0") == "0":
+            return self.atom(0)
+        return self.atom(getattr(self, "init_value", 0))
+
 
 class hdl(PdGui):
     args = PdObject.args + [
@@ -127,6 +186,14 @@ class hdl(PdGui):
         "default_value",  # default value when the [init] attribute is not set
     ]
 
+    def range(self):
+        return 0.0, float(self.number) - 1, False
+
+    def default(self):
+        if getattr(self, "init", "0") == "0":
+            return self.atom(0)
+        return self.atom(getattr(self, "default_value", 0))
+
 hradio = vdl = vradio = hdl
 
 
@@ -152,5 +219,24 @@ class hsl(PdGui):
         "steady_on_click",  # when set, fader is steady, otherwise it jumps
     ]
 
+    def range(self):
+        return float(self.bottom), float(self.top), self.log != "0"
+
+    def default(self):
+        # Pd saves the position in hundredths of a pixel along the slider
+        if getattr(self, "init", "0") == "0":
+            return self.atom(0, scaled=True)
+        length = float(self.height if self.name in ("vsl", "vslider")
+                       else self.width)
+        return self.atom(float(getattr(self, "default_value", 0)) /
+                         (100 * max(length - 1, 1)), scaled=True)
+
 # Vertical sliders' args are identical to horizontal ones
 hslider = vsl = vslider = hsl
+
+# Every object name Pd may use for one of the classes above
+guiClasses = {name: cls for name, cls in list(globals().items())
+              if isinstance(cls, type) and issubclass(cls, PdGui) and
+              cls is not PdGui}
+# the start of an element creating any of them, as a regular expression
+guiPattern = r"#X obj -?\d+ -?\d+ (?:{})[ ;]".format("|".join(guiClasses))
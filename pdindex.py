@@ -0,0 +1,126 @@
+import json
+import os
+
+from pypd import PdParser
+from pypd.PdCache import cachePath
+import pdgui
+
+INDEX_FILE = ".classes.json"
+# objects whose first argument is a name messages can be sent to
+RECEIVERS = frozenset(["r", "receive", "r~", "receive~", "catch~"])
+
+
+def _scan(filename):
+    # (class, canvas, object number) for every object in filename, and
+    # (receive name, canvas, object number) for everything listening on one
+    p = PdParser(filename)
+    uses, receives = [], []
+
+    def found(canvasStack, type, action, args):
+        index = p.objectIndex
+        if index is None:
+            return
+        canvas = "/".join(canvasStack[1:]) or "-"
+        bits = args.split()
+        cls = bits[2] if action in ("obj", "restore") and len(bits) > 2 \
+            else action
+        uses.append((cls, canvas, index))
+        if cls in RECEIVERS and len(bits) > 3:
+            receives.append((bits[3], canvas, index))
+        elif cls in pdgui.guiClasses:
+            control = pdgui.guiClasses[cls](bits)
+            if control.addressable():
+                receives.append((control.receive, canvas, index))
+
+    p.add_filter_method(found, type="#X")
+    p.parse()
+    return uses, receives
+
+
+class PdClassIndex(object):
+    """Which patches in a directory use each object class, and which listen
+    on each receive name, down to canvas and object number.
+
+    Only files whose modification time changed are parsed again when the
+    index is refreshed, and the index can be saved to the cache directory
+    so a later run starts from it."""
+
+    def __init__(self, patchDir):
+        self.patchDir = patchDir
+        self.path = cachePath(patchDir, INDEX_FILE)
+        # filename -> (mtime, uses, receives), as _scan() returns them
+        self._files = {}
+        # class or receive name -> filename -> [(canvas, object number)]
+        self._classes = {}
+        self._receives = {}
+
+    def _post(self, postings, filename, entries, add=True):
+        for key, canvas, index in entries:
+            files = postings.setdefault(key, {})
+            if add:
+                files.setdefault(filename, []).append((canvas, index))
+            else:
+                files.pop(filename, None)
+                if not files:
+                    del postings[key]
+
+    def _forget(self, filename):
+        mtime, uses, receives = self._files.pop(filename)
+        self._post(self._classes, filename, uses, add=False)
+        self._post(self._receives, filename, receives, add=False)
+
+    def _add(self, filename, mtime, uses, receives):
+        self._files[filename] = (mtime, uses, receives)
+        self._post(self._classes, filename, uses)
+        self._post(self._receives, filename, receives)
+
+    def refresh(self):
+        """Bring the index up to date with the directory. Returns how many
+        files had to be parsed."""
+        present = {}
+        for name in os.listdir(self.patchDir):
+            if name.endswith(".pd"):
+                filename = os.path.join(self.patchDir, name)
+                present[filename] = os.stat(filename).st_mtime
+        parsed = 0
+        for filename in list(self._files):
+            if present.get(filename) != self._files[filename][0]:
+                self._forget(filename)
+        for filename, mtime in present.items():
+            if filename not in self._files:
+                self._add(filename, mtime, *_scan(filename))
+                parsed += 1
+        return parsed
+
+    def uses(self, cls):
+        """Map of filename to the (canvas, object number)s of each cls
+        object in it."""
+        return {f: list(where)
+                for f, where in self._classes.get(cls, {}).items()}
+
+    def patches(self, cls):
+        """Patch files using cls somewhere."""
+        return sorted(self._classes.get(cls, {}))
+
+    def receivers(self, name):
+        """Map of filename to the (canvas, object number)s of everything in
+        it receiving name: [r], [r~], [catch~] and GUI controls."""
+        return {f: list(where)
+                for f, where in self._receives.get(name, {}).items()}
+
+    def classes(self):
+        return sorted(self._classes)
+
+    def save(self, filename=None):
+        with open(filename or self.path, "w") as indexFile:
+            json.dump(self._files, indexFile, separators=(",", ":"))
+
+    def load(self, filename=None):
+        """Start from an index written by save(); files changed since are
+        parsed again on the next refresh()."""
+        with open(filename or self.path) as indexFile:
+            for f, (mtime, uses, receives) in json.load(indexFile).items():
+                if f in self._files:
+                    self._forget(f)
+                self._add(f, mtime, [tuple(u) for u in uses],
+                          [tuple(r) for r in receives])
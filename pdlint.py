@@ -0,0 +1,307 @@
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from pypd import PdParser
+
+ERROR, WARNING = "error", "warning"
+
+# [metro]s faster than this many milliseconds cost more than they're worth
+METRO_MIN_MS = 5.0
+# control sources firing more often than this make [print] flood stderr
+PRINT_MIN_MS = 100.0
+# objects where a signal ends up doing something
+SIGNAL_SINKS = frozenset([
+    "dac~", "outlet~", "s~", "send~", "throw~", "writesf~", "tabwrite~",
+    "tabsend~", "delwrite~", "print~", "pd",
+])
+# objects sending control messages every DSP block
+BLOCK_RATE = frozenset(["bang~", "env~", "sigmund~", "fiddle~", "bonk~"])
+FFT_CLASSES = frozenset(["fft~", "ifft~", "rfft~", "rifft~"])
+
+
+class Finding(namedtuple("Finding",
+                         "file canvas index x y severity rule message")):
+    """One problem found, at object index on canvas (a "/" separated path of
+    subpatch names, "-" for the top level) of file."""
+    __slots__ = ()
+
+    def __str__(self):
+        return "{}:{}:{} ({}, {}): {}: {}: {}".format(*self)
+
+
+class _Canvas(object):
+    def __init__(self, path):
+        self.path = path
+        # object number -> (name, creation arguments, x, y)
+        self.objects = {}
+        # (from, outlet, to, inlet)
+        self.connections = []
+        # object number -> connections out of and into it, built on first
+        # use once the canvas has been read
+        self._outgoing = None
+        self._incoming = None
+
+    def _link(self):
+        if self._outgoing is None:
+            self._outgoing, self._incoming = {}, {}
+            for c in self.connections:
+                self._outgoing.setdefault(c[0], []).append(c[2])
+                self._incoming.setdefault(c[2], []).append(c)
+
+    def outgoing(self, index):
+        self._link()
+        return self._outgoing.get(index, [])
+
+    def incoming(self, index):
+        """The (from, outlet, to, inlet) connections into object index."""
+        self._link()
+        return self._incoming.get(index, [])
+
+    def cyclic(self):
+        """Object numbers on a feedback loop, found with an iterative
+        Tarjan's strongly connected components search."""
+        self._link()
+        order, low, stack, onStack, found = {}, {}, [], set(), set()
+
+        def visit(node):
+            order[node] = low[node] = len(order)
+            stack.append(node)
+            onStack.add(node)
+            work.append((node, iter(self.outgoing(node))))
+
+        for root in list(self._outgoing):
+            if root in order:
+                continue
+            work = []
+            visit(root)
+            while work:
+                node, following = work[-1]
+                for child in following:
+                    if child not in order:
+                        visit(child)
+                        break
+                    elif child in onStack:
+                        low[node] = min(low[node], order[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == order[node]:
+                        component = []
+                        while not component or component[-1] != node:
+                            component.append(stack.pop())
+                            onStack.discard(component[-1])
+                        if len(component) > 1 or node in self.outgoing(node):
+                            found.update(component)
+        return found
+
+    def reachable(self, start):
+        seen, todo = set(), [start]
+        while todo:
+            index = todo.pop()
+            for following in self.outgoing(index):
+                if following not in seen:
+                    seen.add(following)
+                    todo.append(following)
+        return seen
+
+
+def _number(atom):
+    try:
+        return float(atom)
+    except ValueError:
+        return None
+
+
+def _readCanvases(filename):
+    # One _Canvas per canvas in filename, filled in by parser filters.
+    p = PdParser(filename)
+    canvases, stack = [], []
+
+    def found_canvas(canvasStack, type, action, args):
+        canvas = _Canvas("/".join(canvasStack[1:]) or "-")
+        canvases.append(canvas)
+        stack.append(canvas)
+
+    def found_element(canvasStack, type, action, args):
+        if action == "restore":
+            stack.pop()
+        index = p.objectIndex
+        if index is None or not stack:
+            return
+        bits = args.split()
+        if action in ("obj", "restore"):
+            name = bits[2] if len(bits) > 2 else ""
+            atoms = bits[3:]
+        else:
+            name, atoms = action, []
+        stack[-1].objects[index] = (name, atoms, bits[0], bits[1])
+
+    def found_connect(canvasStack, type, action, args):
+        stack[-1].connections.append(tuple(map(int, args.split())))
+
+    p.add_filter_method(found_canvas, type="#N", action="canvas")
+    p.add_filter_method(found_element, type="#X")
+    p.add_filter_method(found_connect, type="#X", action="connect")
+    p.parse()
+    return canvases
+
+
+def _checkMetros(filename, canvas):
+    for index, (name, atoms, x, y) in canvas.objects.items():
+        interval = _number(atoms[0]) if name == "metro" and atoms else None
+        if interval is not None and interval < METRO_MIN_MS:
+            yield Finding(filename, canvas.path, index, x, y,
+                          ERROR if interval < 1 else WARNING, "fast-metro",
+                          "[metro {}] fires more than {:.0f} times a "
+                          "second".format(atoms[0], 1000.0 / METRO_MIN_MS))
+
+
+def _checkDeadSignals(filename, canvas):
+    # signal objects whose output never gets anywhere are still computed
+    # every block
+    dead = []
+    for index, (name, atoms, x, y) in sorted(canvas.objects.items()):
+        if not name.endswith("~") or name in SIGNAL_SINKS:
+            continue
+        reached = canvas.reachable(index)
+        if not any(canvas.objects.get(i, ("",))[0] in SIGNAL_SINKS or
+                   not canvas.objects.get(i, ("~",))[0].endswith("~")
+                   for i in reached):
+            dead.append(index)
+    if dead:
+        name, atoms, x, y = canvas.objects[dead[0]]
+        yield Finding(filename, canvas.path, dead[0], x, y, WARNING,
+                      "dead-dsp",
+                      "{} signal object(s) never reach an output but are "
+                      "still computed: {}".format(
+                          len(dead), " ".join(str(i) for i in dead)))
+
+
+def _signatures(canvas):
+    # A number for each object standing for what it computes: its class and
+    # arguments, and the numbers of what's connected into it. Equal numbers
+    # compute the same thing. Objects on a feedback loop get one each.
+    cyclic = canvas.cyclic()
+    keys, numbers = {}, {}
+    for start in canvas.objects:
+        stack = [start]
+        while stack:
+            index = stack[-1]
+            if index in numbers:
+                stack.pop()
+                continue
+            if index in cyclic:
+                key = ("cycle", index)
+            else:
+                waiting = [c[0] for c in canvas.incoming(index)
+                           if c[0] not in numbers]
+                if waiting:
+                    stack.extend(waiting)
+                    continue
+                name, atoms = canvas.objects.get(index, ("", ()))[:2]
+                key = (name, tuple(atoms),
+                       tuple(sorted((c[3], c[1], numbers[c[0]])
+                                    for c in canvas.incoming(index))))
+            numbers[index] = keys.setdefault(key, len(keys))
+            stack.pop()
+    return numbers
+
+
+def _checkDuplicateFfts(filename, canvas):
+    """
+    >>> c = _Canvas("-")
+    >>> c.objects = {0: ("osc~", ["440"], "0", "0"),
+    ...              1: ("*~", ["2"], "0", "0"), 2: ("*~", ["2"], "0", "0"),
+    ...              3: ("+~", [], "0", "0"), 4: ("rfft~", [], "0", "0"),
+    ...              5: ("rfft~", [], "0", "0")}
+    >>> c.connections = [(0, 0, 1, 0), (0, 0, 2, 0), (1, 0, 3, 0),
+    ...                  (2, 0, 3, 1), (3, 0, 4, 0), (3, 0, 5, 0)]
+    >>> [f.index for f in _checkDuplicateFfts("x.pd", c)]
+    [5]
+
+    Squaring a signal over and over doesn't take exponential time:
+
+    >>> c = _Canvas("-")
+    >>> c.objects = {n: ("*~", [], "0", "0") for n in range(200)}
+    >>> c.objects[200] = ("rfft~", [], "0", "0")
+    >>> c.connections = [(n, 0, n + 1, i) for n in range(200) for i in (0, 1)]
+    >>> list(_checkDuplicateFfts("x.pd", c))
+    []
+    """
+    signatures = {}
+    numbers = _signatures(canvas)
+    for index, (name, atoms, x, y) in sorted(canvas.objects.items()):
+        if name not in FFT_CLASSES or not canvas.incoming(index):
+            continue
+        key = numbers[index]
+        if key in signatures:
+            yield Finding(filename, canvas.path, index, x, y, WARNING,
+                          "duplicate-fft",
+                          "[{}] computes the same thing as object {}".format(
+                              name, signatures[key]))
+        else:
+            signatures[key] = index
+
+
+def _checkPrints(filename, canvas):
+    for index, (name, atoms, x, y) in sorted(canvas.objects.items()):
+        interval = _number(atoms[0]) if name == "metro" and atoms else None
+        if name in BLOCK_RATE:
+            severity, why = ERROR, "every DSP block"
+        elif interval is not None and interval < PRINT_MIN_MS:
+            severity, why = WARNING, "every {} ms".format(atoms[0])
+        else:
+            continue
+        for printer in sorted(canvas.reachable(index)):
+            if canvas.objects.get(printer, ("", ))[0] == "print":
+                __, __, px, py = canvas.objects[printer]
+                yield Finding(filename, canvas.path, printer, px, py,
+                              severity, "print-flood",
+                              "[print] gets messages {} from [{}] (object "
+                              "{}), flooding Pd's stderr".format(
+                                  why, name, index))
+
+
+CHECKS = [_checkMetros, _checkDeadSignals, _checkDuplicateFfts, _checkPrints]
+
+
+def lintFile(filename):
+    """Findings for one patch file, in the order of CHECKS."""
+    findings = []
+    for canvas in _readCanvases(filename):
+        for check in CHECKS:
+            findings.extend(check(filename, canvas))
+    return findings
+
+
+def lintLibrary(filenames, processes=None):
+    """Lint many patch files across processes, or right here for a single
+    file or processes=1. Returns their findings in the order of filenames.
+
+    Workers are spawned rather than forked, as the shell runs this from a
+    thread while others hold locks a forked child would inherit held.
+    """
+    filenames = list(filenames)
+    findings = []
+    if len(filenames) <= 1 or processes == 1:
+        for filename in filenames:
+            findings.extend(lintFile(filename))
+        return findings
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(processes, mp_context=context) as pool:
+        for fileFindings in pool.map(lintFile, filenames):
+            findings.extend(fileFindings)
+    return findings
+
+
+def patchFiles(patchDir, names=()):
+    """The .pd files for names in patchDir, or all of them."""
+    if names:
+        return [os.path.join(patchDir, n if n.endswith(".pd") else n + ".pd")
+                for n in names]
+    return sorted(os.path.join(patchDir, f) for f in os.listdir(patchDir)
+                  if f.endswith(".pd"))
@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+
+from pypd.PdCache import cachePath
+from pypd.PdResolver import PdResolver
+from pypd.PdWriter import PdWriter
+from pd import pd
+from pdcompile import ChainCompiler
+
+COST_FILE = ".costs.json"
+PROFILE_SECONDS = 20
+
+
+try:
+    import resource
+except ImportError:
+    # Windows: batch mode Pd runs flat out, so the wall clock time it takes
+    # stands in for its CPU time
+    resource = None
+
+
+def _childCpuTime():
+    if resource is None:
+        return time.perf_counter()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def writeProfilePatch(path, seconds):
+    """Write a base patch that feeds white noise through one channel for
+    seconds of audio and then quits Pd. Returns (ins, outs) for
+    ChainCompiler."""
+    with open(path, "w") as patchFile:
+        w = PdWriter(patchFile)
+        w.canvas(100, 100, 560, 420)
+        loadbang = w.obj(10, 10, "loadbang")
+        trigger = w.obj(10, 32, "t", "b", "b")
+        dsp = w.msg(100, 54, ";", "pd", "dsp", 1)
+        delay = w.obj(10, 54, "delay", seconds * 1000.0)
+        quit = w.msg(10, 76, ";", "pd", "quit")
+        noise = w.obj(40, 80, "noise~")
+        inlet = w.obj(40, 100, "*~", 1)
+        outlet = w.obj(40, 360, "*~", 1)
+        w.connect(loadbang, 0, trigger, 0)
+        w.connect(trigger, 1, dsp, 0)
+        w.connect(trigger, 0, delay, 0)
+        w.connect(delay, 0, quit, 0)
+        w.connect(noise, 0, inlet, 0)
+        w.connect(inlet, 0, outlet, 0)
+    return [inlet], [outlet]
+
+
+def measure(names, patchDir, seconds=PROFILE_SECONDS, bin=None):
+    """CPU seconds batch mode Pd spends running names (a chain of effects
+    from patchDir) over seconds of audio, Pd's own overhead included."""
+    workDir = mkdtemp(prefix="pd-profile-")
+    try:
+        basePatch = os.path.join(workDir, "profile-base.pd")
+        ins, outs = writeProfilePatch(basePatch, seconds)
+        compiler = ChainCompiler(basePatch, ins, outs,
+                                 PdResolver([patchDir]))
+        patch = compiler.compile([names],
+                                 os.path.join(workDir, "profile.pd"))
+        before = _childCpuTime()
+        pd(initPatch=patch, offline=True, controlWindow=0, path=[patchDir],
+           bin=bin).wait()
+        return _childCpuTime() - before
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+class PdCostDb(object):
+    """CPU cost of each effect, as the fraction of one core it takes to run
+    in real time, kept in a JSON file in the cache directory. A cost is
+    forgotten once its patch file changes."""
+
+    def __init__(self, patchDir):
+        self.patchDir = patchDir
+        self.path = cachePath(patchDir, COST_FILE)
+        # effect name -> {"cost": fraction of a core, "mtime": patch mtime}
+        self.entries = {}
+        try:
+            with open(self.path) as costFile:
+                self.entries = json.load(costFile)
+        except (IOError, ValueError):
+            pass
+
+    def _mtime(self, name):
+        try:
+            return os.stat(os.path.join(self.patchDir, name + ".pd")).st_mtime
+        except OSError:
+            return None
+
+    def cost(self, name):
+        entry = self.entries.get(name)
+        if entry is None or entry["mtime"] != self._mtime(name):
+            return None
+        return entry["cost"]
+
+    def projected(self, names):
+        """Total cost of running names together; unmeasured ones count as
+        free."""
+        return sum(self.cost(name) or 0 for name in names)
+
+    def profile(self, names, seconds=PROFILE_SECONDS, bin=None):
+        """Measure each of names on its own against an empty chain, record
+        the results and save the database."""
+        baseline = measure([], self.patchDir, seconds, bin)
+        for name in names:
+            used = measure([name], self.patchDir, seconds, bin)
+            self.entries[name] = {"cost": max(0.0, used - baseline) / seconds,
+                                  "mtime": self._mtime(name)}
+            self.save()
+
+    def save(self):
+        with open(self.path, "w") as costFile:
+            json.dump(self.entries, costFile, indent=1, sort_keys=True)
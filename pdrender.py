@@ -0,0 +1,117 @@
+import os
+import shutil
+import subprocess
+import wave
+from tempfile import mkdtemp
+
+from pypd.PdResolver import PdResolver
+from pypd.PdWriter import PdWriter
+from pd import pd, PdException
+from pdcompile import ChainCompiler
+
+CHANNELS = 2
+# Heavy chains can render slower than real time, so Pd gets this many times
+# the input's length, plus the tail and a margin, before it's given up on
+RENDER_SLOWDOWN = 4
+RENDER_MARGIN = 30.0
+# seconds to wait when the input's length can't be told from its header
+RENDER_TIMEOUT = 600.0
+
+
+def inputSeconds(inFile):
+    """Length of inFile in seconds if it's a .wav file, or None. Raises
+    OSError if it can't be read at all, as Pd would never finish it."""
+    with open(inFile, "rb"):
+        pass
+    try:
+        with wave.open(inFile) as waveFile:
+            return waveFile.getnframes() / float(waveFile.getframerate())
+    except (wave.Error, EOFError):
+        return None
+
+
+def renderTimeout(inFile, tail=0):
+    seconds = inputSeconds(inFile)
+    if seconds is None:
+        return RENDER_TIMEOUT
+    return seconds * RENDER_SLOWDOWN + tail / 1000.0 + RENDER_MARGIN
+
+
+def writeRenderPatch(path, inFile, outFile, channels=CHANNELS, tail=0):
+    """Write a base patch that plays inFile through to outFile and quits Pd
+    tail milliseconds after the input runs out. Returns the per-channel
+    (ins, outs) objects to wire effect chains between, as ChainCompiler
+    takes them."""
+    with open(path, "w") as patchFile:
+        w = PdWriter(patchFile)
+        w.canvas(100, 100, 560, 420)
+        loadbang = w.obj(10, 10, "loadbang")
+        trigger = w.obj(10, 32, "t", "b", "b", "b")
+        openOut = w.msg(300, 340, "open", os.path.abspath(outFile), ",",
+                        "start")
+        writesf = w.obj(40, 380, "writesf~", channels)
+        openIn = w.msg(100, 54, "open", os.path.abspath(inFile), ",",
+                       "start")
+        readsf = w.obj(40, 80, "readsf~", channels)
+        dsp = w.msg(220, 54, ";", "pd", "dsp", 1)
+        ins = [w.obj(40 + 275 * c, 100, "*~", 1) for c in range(channels)]
+        outs = [w.obj(40 + 275 * c, 360, "*~", 1) for c in range(channels)]
+        delay = w.obj(400, 80, "delay", tail)
+        finish = w.obj(400, 102, "t", "b", "b")
+        stop = w.msg(400, 124, "stop")
+        quit = w.msg(450, 124, ";", "pd", "quit")
+        w.connect(loadbang, 0, trigger, 0)
+        # right to left: output file open before the input starts playing
+        w.connect(trigger, 2, openOut, 0)
+        w.connect(trigger, 1, openIn, 0)
+        w.connect(trigger, 0, dsp, 0)
+        w.connect(openOut, 0, writesf, 0)
+        w.connect(openIn, 0, readsf, 0)
+        for c in range(channels):
+            w.connect(readsf, c, ins[c], 0)
+            w.connect(ins[c], 0, outs[c], 0)
+            w.connect(outs[c], 0, writesf, c)
+        w.connect(readsf, channels, delay, 0)
+        w.connect(delay, 0, finish, 0)
+        w.connect(finish, 1, stop, 0)
+        w.connect(finish, 0, quit, 0)
+        w.connect(stop, 0, writesf, 0)
+    return ins, outs
+
+
+def render(chains, inFile, outFile, patchDir, tail=0, rate=None,
+           inline=(), bin=None, timeout=None):
+    """Run inFile through chains[channel] (effect names from patchDir, in
+    order) into outFile with Pd in batch mode, which needs no sound card and
+    goes as fast as the CPU allows. tail milliseconds of silence are
+    rendered after the input ends, for reverbs and delays to ring out.
+    Returns Pd's exit status.
+
+    Pd is killed and PdException raised if it hasn't finished after timeout
+    seconds, by default worked out from the input's length."""
+    if timeout is None:
+        timeout = renderTimeout(inFile, tail)
+    workDir = mkdtemp(prefix="pd-render-")
+    try:
+        basePatch = os.path.join(workDir, "render-base.pd")
+        ins, outs = writeRenderPatch(basePatch, inFile, outFile,
+                                     max(CHANNELS, len(chains)), tail)
+        compiler = ChainCompiler(basePatch, ins, outs,
+                                 PdResolver([patchDir]))
+        renderPatch = compiler.compile(chains,
+                                       os.path.join(workDir, "render.pd"),
+                                       inline)
+        offline = pd(initPatch=renderPatch, offline=True, controlWindow=0,
+                     path=[patchDir], rate=rate, bin=bin)
+        try:
+            return offline.wait(timeout)
+        except subprocess.TimeoutExpired:
+            offline.proc.kill()
+            offline.proc.wait()
+            raise PdException("Rendering {} took over {:.0f} seconds, so Pd "
+                              "was killed".format(inFile, timeout))
+        except BaseException:
+            offline.kill()
+            raise
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
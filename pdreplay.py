@@ -0,0 +1,50 @@
+# python3
+
+import argparse
+import socket
+import sys
+import time
+
+from pypd.PdRecorder import replay, OUT, IN
+
+
+def setupParser():
+    parser = argparse.ArgumentParser(
+        description="Play a recording of Pd messages back to a Pd (or "
+                    "anything else listening for FUDI over TCP).")
+    parser.add_argument("recording",
+                        help="File written by pd.record() or Pd.Record().")
+    parser.add_argument("address", nargs="?", default="127.0.0.1:3000",
+                        help="host:port to send to (default: the patch "
+                             "bay's [netreceive], %(default)s).")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Playback speed; 0 sends as fast as possible.")
+    parser.add_argument("--inbound", dest="direction", action="store_const",
+                        const=IN, default=OUT,
+                        help="Replay the messages Pd sent instead, standing "
+                             "in for Pd.")
+    return parser
+
+
+def main(argv=None):
+    args = setupParser().parse_args(argv)
+    host, __, port = args.address.rpartition(":")
+    connection = socket.create_connection((host or "127.0.0.1", int(port)))
+    sizes = []
+
+    def send(payload):
+        connection.sendall(payload)
+        sizes.append(len(payload))
+
+    started = time.monotonic()
+    try:
+        count = replay(args.recording, send, args.speed, args.direction)
+    finally:
+        connection.close()
+    elapsed = time.monotonic() - started
+    print("Sent {} messages ({} bytes) in {:.3f}s, {:.0f} messages/s".format(
+        count, sum(sizes), elapsed, count / elapsed if elapsed else 0))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,8 @@
 from pypd.monkeysubprocess import Popen, PIPE
 import os
 import os.path
+import io
+import shutil
 import sys
 import signal
 import asyncore
@@ -16,6 +18,16 @@ import asynchat
 import socket
 import select
 import re
+from contextlib import closing
+from tempfile import mkdtemp
+
+from pypd.PdArrays import PdArrayTransfer
+from pypd.PdCoalescer import PdCoalescer, DEFAULT_MAXLEN
+from pypd.PdMonitor import PdDspMonitor
+from pypd.PdProbe import PdLatencyProbe
+from pypd.PdRecorder import PdRecorder, OUT, IN
+from pypd.PdTrace import instant
+from pypd.PdWriter import PdWriter
 
 if hasattr(select, 'poll'):
     from asyncore import poll2 as poll
@@ -43,6 +55,8 @@ class PdSend(asynchat.async_chat):
         asynchat.async_chat.__init__(self, map=map)
         self._cache = []
         self._success = False
+        # a PdRecorder logging what goes out, if any
+        self.recorder = None
 
     def handle_connect(self):
         self._success = True
@@ -61,9 +75,11 @@ class PdSend(asynchat.async_chat):
 
     def Send(self, data):
         if self._success:
-            asynchat.async_chat.push(
-                self,
-                " ".join([str(d) for d in data]) + ";" + os.linesep)
+            payload = (" ".join([str(d) for d in data]) + ";" +
+                       os.linesep).encode("utf-8")
+            if self.recorder:
+                self.recorder.record(OUT, payload)
+            asynchat.async_chat.push(self, payload)
         else:
             self._cache.append(data)
 
@@ -72,8 +88,10 @@ class PdReceive(asynchat.async_chat):
     def __init__(self, parent, localaddr=("127.0.0.1", 30322), map=None):
         self._parent = parent
         asynchat.async_chat.__init__(self, map=map)
-        self._ibuffer = ""
-        self.set_terminator(";\n")
+        self._ibuffer = b""
+        self.set_terminator(b";\n")
+        # a PdRecorder logging what comes in, if any
+        self.recorder = None
         # address of Pd connection socket
         self._remote = ""
         # set up the server socket to do the accept() from Pd's socket
@@ -101,23 +119,111 @@ class PdReceive(asynchat.async_chat):
     def handle_connect(self):
         self._parent.Connect(self._remote)
 
+    @property
+    def source(self):
+        return self._remote
+
     def collect_incoming_data(self, data):
         self._ibuffer += data
 
     def found_terminator(self):
-        data = self._ibuffer.split(" ")
-        self._ibuffer = ""
-
-        method = getattr(self._parent, 'Pd_' + data[0], None)
-        if method:
-            method(self, data[1:])
-        else:
-            self._parent.PdMessage(data)
+        if self.recorder:
+            self.recorder.record(IN, self._ibuffer + self.terminator)
+        data = self._ibuffer.decode("utf-8").split(" ")
+        self._ibuffer = b""
+        _dispatch(self._parent, self, data)
 
     def close(self):
         self._serversocket.close()
 
 
+def _dispatch(parent, receiver, data):
+    method = getattr(parent, 'Pd_' + data[0], None)
+    if method:
+        method(receiver, data[1:])
+    elif hasattr(parent, "PdMessageFrom"):
+        parent.PdMessageFrom(receiver.source, data)
+    else:
+        parent.PdMessage(data)
+
+
+class PdReceiveServer(asyncore.dispatcher):
+    """
+    Accept messages from any number of Pd connections on one port.
+
+    Unlike PdReceive, the server keeps listening, so several Pd processes
+    (each with a [python-interface] or [netsend]) can report back to one
+    event loop. Every connection gets a PdReceiveChannel whose source is
+    the remote address. Messages are handed to the parent's Pd_xxx
+    methods with their channel, or to PdMessageFrom(source, data), or to
+    PdMessage(data) if the parent has no PdMessageFrom.
+    """
+    def __init__(self, parent, localaddr=("127.0.0.1", 30322), map=None,
+                 backlog=16):
+        asyncore.dispatcher.__init__(self, map=map)
+        self._parent = parent
+        self._map = map
+        # remote address -> PdReceiveChannel, for each open connection
+        self.channels = {}
+        # a PdRecorder logging what comes in on every channel, if any
+        self.recorder = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(localaddr)
+        self.listen(backlog)
+
+    def handle_accept(self):
+        accepted = self.accept()
+        if accepted:
+            conn, addr = accepted
+            self.channels[addr] = PdReceiveChannel(self, conn, addr,
+                                                   map=self._map)
+            connected = getattr(self._parent, "PdConnected", None)
+            if connected:
+                connected(addr)
+
+    def _closed(self, channel):
+        self.channels.pop(channel.source, None)
+        disconnected = getattr(self._parent, "PdDisconnected", None)
+        if disconnected:
+            disconnected(channel.source)
+
+    def close(self):
+        for channel in list(self.channels.values()):
+            channel.close()
+        asyncore.dispatcher.close(self)
+
+
+class PdReceiveChannel(asynchat.async_chat):
+    """
+    One Pd connection accepted by a PdReceiveServer.
+    """
+    def __init__(self, server, conn, source, map=None):
+        asynchat.async_chat.__init__(self, sock=conn, map=map)
+        self._server = server
+        self._ibuffer = b""
+        # (host, port) the messages on this connection come from
+        self.source = source
+        self.set_terminator(b";\n")
+
+    def collect_incoming_data(self, data):
+        self._ibuffer += data
+
+    def found_terminator(self):
+        if self._server.recorder:
+            self._server.recorder.record(IN, self._ibuffer + self.terminator)
+        data = self._ibuffer.decode("utf-8").split(" ")
+        self._ibuffer = b""
+        _dispatch(self._server._parent, self, data)
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        asynchat.async_chat.close(self)
+        self._server._closed(self)
+
+
 class Pd:
     """
         Start Pure Data in a subprocess.
@@ -178,23 +284,32 @@ class Pd:
 
     def __init__(
             self,
-            port=30321,
+            port=None,
             nogui=True,
             open="python-interface-help.pd",
             cmd=None,
             path=["patches"],
             extra=None,
             stderr=True,
-            pdexe=None
+            pdexe=None,
+            coalesce=None,
+            queue=DEFAULT_MAXLEN
     ):
         """
-        port - what port to connect to [netreceive] on.
+        port - what port to connect to [netreceive] on. Defaults to a free
+            one, so any number of Pds can run side by side, with another
+            free one for Pd to connect back to. The open patch gets them as
+            its $1 and $2, to hand on to [python-interface $1 $2]; with a
+            port given, Pd connects back to 30322 as it always did.
         nogui - boolean: whether to start Pd with or without a gui.
             Defaults to nogui=True
         open - string: full path to a .pd file to open on startup.
         cmd - message to send to Pd on startup.
         path - an array of paths to add to Pd startup path.
         extra - a string containing extra command line arguments to pass to Pd.
+        coalesce - seconds SendControl() messages wait for newer values for
+            the same target before being sent. Defaults to no waiting.
+        queue - most targets allowed to wait at once when coalescing.
         """
         self.connectCallback = None
 
@@ -206,16 +321,31 @@ class Pd:
         if nogui:
             args.append("-nogui")
 
+        self.port = port or _freePort()
+        receivePort = 30322 if port else _freePort()
+        self._launchDir = None
         if open:
             if not os.path.isabs(open):
                 open = os.path.join(os.path.dirname(__file__), "patches", open)
-            args.append("-open")
-            args.append(open)
+            # -open can't pass arguments, so open a patch holding the real
+            # one as an abstraction with the port as its argument
+            self._launchDir = mkdtemp(prefix="pypd-")
+            name = os.path.splitext(os.path.basename(open))[0]
+            launcher = os.path.join(self._launchDir, "launch.pd")
+            with io.open(launcher, "w") as launchFile:
+                w = PdWriter(launchFile)
+                w.canvas(0, 0, 450, 300)
+                w.obj(10, 10, name, self.port, receivePort)
+            args += ["-path", os.path.dirname(open), "-open", launcher]
+            if not nogui:
+                args += ["-send", "pd-{}.pd vis 1".format(name)]
 
         if cmd:
             args.append("-send")
             args.append(cmd)
 
+        # kept so abstractions can be resolved the way this Pd will
+        self.path = list(path)
         for p in path:
             args.append("-path")
             args.append(p)
@@ -231,14 +361,25 @@ class Pd:
             raise PdException(
                 "Problem running `{}` from '{}'".format(pdexe, os.getcwd()))
 
-        if port:
-            self.port = port
-
         self._map = {}
         self._pdSend = PdSend(map=self._map)
-        self._pdReceive = PdReceive(self, map=self._map)
+        self._pdReceive = PdReceive(self, ("127.0.0.1", receivePort),
+                                    map=self._map)
+        self._controls = (PdCoalescer(self._SendMany, coalesce, queue,
+                                      timer=False)
+                          if coalesce else None)
+        self.probe = None
+        # audio dropouts and overloads Pd reports on stderr
+        self.monitor = PdDspMonitor()
+        self._arrays = None
 
     def Update(self):
+        if self._controls:
+            self._controls.poll()
+        if self.probe:
+            self.probe.Update()
+        if self._arrays:
+            self._arrays.Update()
         poll(map=self._map)
         stdin = self.pd.recv()
         stderr = self.pd.recv_err()
@@ -254,8 +395,83 @@ class Pd:
 
         p.Send(["my", "test", "yay"])
         """
+        instant("Send", "Pd", message=" ".join(map(str, msg)))
         self._pdSend.Send(msg)
 
+    def SendControl(self, msg):
+        """
+        Send an array of data to Pd like Send(), treating the first element
+        as its target. If coalescing is on, a message still waiting to go out
+        is replaced by a newer one for the same target.
+
+        p.SendControl(["cutoff", 440])
+        """
+        if self._controls:
+            self._controls.push(msg[0], msg)
+        else:
+            self.Send(msg)
+
+    def StartProbe(self, interval=1.0, stall=0.25, onStall=None,
+                   onRecover=None):
+        """
+        Start pinging Pd through [python-interface] from Update(), see
+        PdLatencyProbe. Returns the probe, which is also kept as self.probe.
+
+        p.StartProbe(onStall=lambda waited: print("Pd stalled", waited))
+        """
+        self.probe = PdLatencyProbe(self, interval, stall, onStall,
+                                    onRecover)
+        return self.probe
+
+    def Record(self, out):
+        """
+        Log every message sent to and received from Pd from now on, with
+        timestamps, to out (a filename or binary file). See PdRecorder.
+        Returns the recorder.
+
+        p.Record("show.pdrec")
+        """
+        self.StopRecording()
+        recorder = PdRecorder(out)
+        self._pdSend.recorder = self._pdReceive.recorder = recorder
+        return recorder
+
+    def StopRecording(self):
+        recorder = self._pdSend.recorder
+        self._pdSend.recorder = self._pdReceive.recorder = None
+        if recorder:
+            recorder.close()
+
+    def WriteArray(self, name, data, callback=None):
+        """
+        Load a buffer of float samples into the Pd array or [table] called
+        name in one go, through a memory mapped file. callback gets the
+        number of samples loaded, or None if Pd failed. See PdArrayTransfer.
+
+        p.WriteArray("sample", array("f", samples))
+        """
+        if self._arrays is None:
+            self._arrays = PdArrayTransfer(self)
+        self._arrays.write(name, data, callback)
+
+    def ReadArray(self, name, callback):
+        """
+        Fetch the contents of the Pd array called name; callback gets them
+        as an array("f"), or None if Pd failed.
+        """
+        if self._arrays is None:
+            self._arrays = PdArrayTransfer(self)
+        self._arrays.read(name, callback)
+
+    def _SendMany(self, msgs):
+        for msg in msgs:
+            self._pdSend.Send(msg)
+
+    def Pd_port(self, receiver, data):
+        # [python-interface] announcing the port it listens on, which only
+        # matters to a PdNetworkConnector talking to several Pds
+        pass
+
     def PdMessage(self, data):
         """
         Override this method to receive messages from Pd.
@@ -280,6 +496,8 @@ class Pd:
             method(errors)
         elif error in self.errorCallbacks:
             self.errorCallbacks[error]()
+        elif self.monitor.feed(error):
+            pass
         else:
             print('untrapped stderr output: "' + error + '"')
 
@@ -307,6 +525,7 @@ class Pd:
         """
         Kill the Pd process right now.
         """
+        self.StopRecording()
         if self.Alive():
             #self.close()
             if sys.platform == "win32":
@@ -320,6 +539,16 @@ class Pd:
             self._pdReceive.close()
         if self.pd:
             self.pd.wait()
+        if self._launchDir:
+            shutil.rmtree(self._launchDir, ignore_errors=True)
+            self._launchDir = None
+
+
+def _freePort():
+    # a port nothing on this host listens on right now
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
 
 
 def _test():
@@ -0,0 +1,125 @@
+"""
+Find out when Pd has applied the edits sent to it.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from pypd.PdProbe import SEQUENCE_WRAP
+
+# the [print] in patchbay.pd echoing "ack <n>" messages back on stderr;
+# only whole numbers count, so a number Pd printed as "1e+06" is never
+# taken for another
+ACK_PRINT = "patchbay-ack"
+ACK_RE = re.compile(r"^" + re.escape(ACK_PRINT) + r": (\d+)$")
+# what Pd prints when a message or object it was sent doesn't work out
+ERROR_RE = re.compile(r"^(error: |\.\.\. couldn't create|bad arguments|"
+                      r".*: no method for|.*: unknown message)")
+
+
+class PdEditError(Exception):
+    """Pd complained about edits sent before an ack; errors are the lines
+    it printed."""
+    def __init__(self, sequence, errors):
+        Exception.__init__(self, "; ".join(errors))
+        self.sequence = sequence
+        self.errors = errors
+
+
+class PdAcks:
+    """
+    Number batches of edits and resolve a Future for each once Pd echoes its
+    number back.
+
+    Every batch ends with "ack <n>", which patchbay.pd prints to stderr.
+    Pd handles what reaches its [netreceive] in order, and prints errors on
+    the same stderr as it goes, so when "patchbay-ack: <n>" turns up
+    everything before it has been applied, and any errors printed since the
+    previous ack came from this batch. Nothing waits for an ack before the
+    next batch goes out, so any number can be in flight at once.
+
+    >>> acks = PdAcks()
+    >>> first, done = acks.next("started")
+    >>> second, failed = acks.next()
+    >>> acks.feed("patchbay-ack: 1")
+    True
+    >>> done.result()
+    'started'
+    >>> acks.feed("foo~ 1")
+    >>> acks.feed("... couldn't create")
+    >>> acks.feed("patchbay-ack: 2")
+    True
+    >>> failed.exception().errors
+    ["foo~ 1 ... couldn't create"]
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sequence = 0
+        # sequence number -> (Future, value) for batches not acked yet
+        self._outstanding = OrderedDict()
+        self._errors = []
+        self._previous = None
+
+    def next(self, value=None):
+        """
+        A sequence number for the next batch, and the Future resolving to
+        value once Pd acks it.
+        """
+        future = Future()
+        with self._lock:
+            # 1 up to SEQUENCE_WRAP - 1, all of which Pd prints in full
+            self._sequence = self._sequence % (SEQUENCE_WRAP - 1) + 1
+            self._outstanding[self._sequence] = (future, value)
+            return self._sequence, future
+
+    def pending(self):
+        return len(self._outstanding)
+
+    def feed(self, line):
+        """
+        Look at one line of Pd's stderr. Returns True if it was an ack,
+        which needs no printing, and None otherwise.
+        """
+        ack = ACK_RE.match(line)
+        if not ack:
+            if ERROR_RE.match(line):
+                if line.startswith("...") and self._previous is not None:
+                    # Pd prints the object's text on the line before
+                    line = self._previous + " " + line
+                self._errors.append(line)
+            self._previous = line
+            return None
+        self._previous = None
+        sequence = int(ack.group(1))
+        with self._lock:
+            if sequence not in self._outstanding:
+                return True
+            errors, self._errors = self._errors, []
+            # earlier batches whose acks went missing were applied too
+            while True:
+                number, (future, value) = self._outstanding.popitem(last=False)
+                if number == sequence:
+                    break
+                future.set_result(value)
+        if errors:
+            future.set_exception(PdEditError(sequence, errors))
+        else:
+            future.set_result(value)
+        return True
+
+    def fail(self, error):
+        """Fail every batch still waiting, as Pd won't be acking them."""
+        with self._lock:
+            outstanding, self._outstanding = self._outstanding, OrderedDict()
+        for future, value in outstanding.values():
+            future.set_exception(error)
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,165 @@
+"""
+Move sample data between Python and Pd arrays through memory mapped files.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+
+from pypd.PdProbe import SEQUENCE_WRAP
+
+# a RAM backed filesystem where there is one, so nothing touches the disk
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+# seconds to wait for Pd's answer before a transfer counts as failed
+TRANSFER_TIMEOUT = 10.0
+
+
+def _floats(data):
+    # A float32 view of data, without copying when it's already one
+    try:
+        view = memoryview(data)
+    except TypeError:
+        view = None
+    if view is not None and view.format in ("f", "<f", "=f") and \
+            view.contiguous and \
+            (view.format != "<f" or sys.byteorder == "little"):
+        return view.cast("B")
+    return memoryview(array("f", data)).cast("B")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class PdArrayTransfer:
+    """
+    Copy whole arrays in and out of Pd's [table]s and [array]s in one go.
+
+    Samples are written straight into a memory mapped raw float file in
+    shared memory and Pd is told to load it with [soundfiler], which the
+    [python-interface] abstraction hosts. Reading back works the other way
+    around. Each request carries a number Pd echoes back in its answer,
+    "soundfiled <number> <samples>", so any number of transfers can be in
+    flight at once.
+
+    [soundfiler] says nothing when it fails, so a transfer not answered
+    within timeout seconds is given up on: its file is removed and its
+    callback gets None. Call Update() from the connection's loop to check;
+    Pd.Update() does.
+
+    Pd.WriteArray() and Pd.ReadArray() use one of these.
+    """
+    def __init__(self, connection, directory=SHARED_DIR,
+                 timeout=TRANSFER_TIMEOUT):
+        """
+        connection - a Pd or PdNetworkConnector the arrays live in.
+        directory - where the transfer files go; shared memory by default.
+        timeout - seconds to wait for Pd to answer a transfer.
+        """
+        self.connection = connection
+        self.directory = directory
+        self.timeout = timeout
+        self._sequence = 0
+        # number -> (path, callback, reading, deadline) for each request
+        # Pd hasn't answered
+        self._pending = {}
+        connection.Pd_soundfiled = self._done
+
+    def _tempfile(self, suffix):
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.directory)
+        return fd, path
+
+    def write(self, name, data, callback=None):
+        """
+        Replace the contents of Pd array name with data, resizing it to fit.
+        data is any buffer of 32 bit floats (array("f"), a float32 NumPy
+        array...) or a sequence of numbers. callback gets the number of
+        samples Pd loaded.
+        """
+        raw = _floats(data)
+        fd, path = self._tempfile(".raw")
+        try:
+            if len(raw):
+                os.ftruncate(fd, len(raw))
+                with mmap.mmap(fd, len(raw)) as mapped:
+                    mapped[:] = raw
+        finally:
+            os.close(fd)
+        endianness = "l" if sys.byteorder == "little" else "b"
+        self.connection.Send(["soundfiler", self._request(path, callback,
+                                                          False),
+                              "read", "-raw", 0, 1, 4, endianness, "-resize",
+                              path, name])
+
+    def read(self, name, callback):
+        """
+        Fetch the contents of Pd array name; callback gets them as an
+        array("f") once Pd has written them out.
+        """
+        fd, path = self._tempfile(".snd")
+        os.close(fd)
+        self.connection.Send(["soundfiler", self._request(path, callback,
+                                                          True),
+                              "write", "-nextstep", "-bytes", 4, path, name])
+
+    def _request(self, path, callback, reading):
+        self.Update()
+        # numbers stay below what Pd prints in full, see SEQUENCE_WRAP
+        self._sequence = self._sequence % (SEQUENCE_WRAP - 1) + 1
+        self._pending[self._sequence] = (path, callback, reading,
+                                         time.monotonic() + self.timeout)
+        return self._sequence
+
+    def Update(self):
+        """
+        Give up on transfers Pd hasn't answered in time.
+        """
+        now = time.monotonic()
+        for number, (path, callback, reading, deadline) in \
+                list(self._pending.items()):
+            if now >= deadline:
+                del self._pending[number]
+                _remove(path)
+                if callback:
+                    callback(None)
+
+    def _done(self, receiver, data):
+        request = self._pending.pop(int(float(data[0])), None)
+        if request is None:
+            # answered after it was given up on
+            return
+        path, callback, reading, deadline = request
+        data = data[1:]
+        try:
+            if reading:
+                result = self._load(path)
+            else:
+                result = int(float(data[0]))
+        finally:
+            _remove(path)
+        if callback:
+            callback(result)
+
+    def _load(self, path):
+        # NeXT/Sun .snd: magic, data offset, size, encoding, rate, channels,
+        # big endian unless Pd wrote the little endian "dns." magic
+        samples = array("f")
+        with open(path, "rb") as sndFile:
+            if not os.fstat(sndFile.fileno()).st_size:
+                return samples
+            with mmap.mmap(sndFile.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                little = mapped[:4] == b"dns."
+                offset, = struct.unpack("<I" if little else ">I",
+                                        mapped[4:8])
+                samples.frombytes(mapped[offset:])
+        if little != (sys.byteorder == "little"):
+            samples.byteswap()
+        return samples
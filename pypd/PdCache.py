@@ -0,0 +1,45 @@
+"""
+Where files worked out from patches (indexes, measurements) are kept, so
+they stay out of the patch directories themselves.
+"""
+
+import hashlib
+import os
+
+
+def cacheDir():
+    """
+    $XDG_CACHE_HOME/pypd, ~/.cache/pypd without it, or %LOCALAPPDATA%\\pypd
+    on Windows.
+    """
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base and os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pypd")
+
+
+def cachePath(path, suffix):
+    """
+    The file in cacheDir() holding what's worked out from path (a patch or
+    a patch directory), ending in suffix. The name carries a hash of the
+    absolute path, so patches of the same name in different directories
+    don't share one.
+
+    >>> a, b = cachePath("a/x.pd", ".idx"), cachePath("b/x.pd", ".idx")
+    >>> os.path.dirname(a) == cacheDir(), a == b
+    (True, False)
+    >>> os.path.basename(a).startswith("x.pd-"), a.endswith(".idx")
+    (True, True)
+    """
+    path = os.path.abspath(path)
+    digest = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+    directory = cacheDir()
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # already there, or not writable, which saving will report
+        pass
+    return os.path.join(directory, "{}-{}{}".format(
+        os.path.basename(path), digest, suffix))
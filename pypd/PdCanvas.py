@@ -0,0 +1,249 @@
+"""
+Load a Pd file into a tree of canvases that can be edited and written back.
+"""
+
+import re
+
+from pypd.PdParser import PdParser
+from pypd.PdWriter import OBJECT_ACTIONS
+
+# Vanilla classes that do nothing at all without connections
+INERT_OBJECTS = frozenset("""
+    + - * / pow max min == != > < >= <= && || % mod div abs sqrt exp log sin
+    cos tan atan atan2 mtof ftom dbtorms rmstodb powtodb dbtopow wrap clip
+    f float i int t trigger b bang sel select route spigot moses pack unpack
+    list symbol print metro delay del line timer random change swap loadbang
+    s send r receive expr tabread tabread4
+    osc~ phasor~ cos~ noise~ +~ -~ *~ /~ max~ min~ clip~ wrap~ sqrt~ rsqrt~
+    lop~ hip~ bp~ vcf~ rpole~ rzero~ cpole~ czero~ biquad~ samphold~ line~
+    vline~ sig~ snapshot~ vsnapshot~ env~ threshold~ tabread~ tabread4~
+    tabosc4~ tabwrite~ tabplay~ delread~ delread4~ vd~ fft~ ifft~ rfft~
+    rifft~ framp~ adc~ dac~ s~ send~ r~ receive~ throw~ expr~ fexpr~ mtof~
+    ftom~ dbtorms~ rmstodb~ powtodb~ dbtopow~ abs~ exp~ log~ pow~ readsf~
+    writesf~
+""".split())
+
+dollarArg = re.compile(r"\\\$(\d+)")
+# Elements whose $1, $2... Pd fills in from the creation arguments when it
+# creates them. A message box's $1 means the incoming message's first atom,
+# and comments show it as typed.
+CREATION_ACTIONS = frozenset(["obj", "floatatom", "symbolatom", "listbox",
+                              "array"])
+
+
+class PdCanvas:
+    r"""
+    One canvas of a Pd file: the top level patch or a subpatch.
+
+    elements holds the canvas' lines in file order as (type, action, args)
+    tuples, with a PdCanvas in place of each subpatch. objects holds the
+    position in elements of each object, so objects[n] is the element
+    "#X connect" lines call object n.
+
+    >>> c = PdCanvas.load("patches/parser-test.pd")
+    >>> c.name(0), c.name(1), c.name(2)
+    ('tabwrite~', 'graph', 'metro')
+    >>> c.find("osc~")
+    [13, 17]
+    """
+    def __init__(self, header=""):
+        # arguments of the "#N canvas" line
+        self.header = header
+        self.elements = []
+        self.objects = []
+        # arguments of the "#X restore" line closing a subpatch
+        self.restore = None
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read filename into a tree of canvases, returning the top level one.
+        """
+        stack = []
+
+        def found(canvasStack, type, action, args):
+            if type == "#N" and action == "canvas":
+                canvas = cls(args)
+                if stack:
+                    stack[-1].objects.append(len(stack[-1].elements))
+                    stack[-1].elements.append(canvas)
+                stack.append(canvas)
+            elif type == "#X" and action == "restore" and len(stack) > 1:
+                stack.pop().restore = args
+            else:
+                stack[-1].add((type, action, args))
+
+        p = PdParser(filename)
+        p.add_filter_method(found)
+        p.parse()
+        return stack[0]
+
+    def add(self, element):
+        """
+        Append an element, returning its object number if it is one.
+        """
+        number = None
+        if isinstance(element, PdCanvas) or (
+                element[0] == "#X" and element[1] in OBJECT_ACTIONS):
+            number = len(self.objects)
+            self.objects.append(len(self.elements))
+        self.elements.append(element)
+        return number
+
+    def object(self, n):
+        return self.elements[self.objects[n]]
+
+    def name(self, n):
+        """
+        Class name of object n, "pd" or "graph" for a subpatch, or the
+        element's action for messages, comments and atoms.
+        """
+        element = self.object(n)
+        if isinstance(element, PdCanvas):
+            args = element.restore.split()
+        else:
+            type, action, args = element
+            if action != "obj":
+                return action
+            args = args.split()
+        return args[2] if len(args) > 2 else ""
+
+    def find(self, name):
+        """
+        Numbers of the objects of the given class on this canvas.
+        """
+        return [n for n in range(len(self.objects)) if self.name(n) == name]
+
+    def connections(self):
+        """
+        (fromObject, outlet, toObject, inlet) for each connection.
+        """
+        return [tuple(map(int, e[2].split())) for e in self.elements
+                if not isinstance(e, PdCanvas) and e[1] == "connect"]
+
+    def connect(self, fromObj, outlet, toObj, inlet):
+        self.elements.append(("#X", "connect", "{} {} {} {}".format(
+            fromObj, outlet, toObj, inlet)))
+
+    def disconnect(self, fromObj, outlet, toObj, inlet):
+        args = "{} {} {} {}".format(fromObj, outlet, toObj, inlet)
+        self.elements = [e for e in self.elements
+                         if e != ("#X", "connect", args)]
+
+    def subpatches(self):
+        return [e for e in self.elements if isinstance(e, PdCanvas)]
+
+    def substitute(self, args, suffix=None):
+        r"""
+        Replace $1, $2... with the creation arguments args throughout this
+        canvas and its subpatches, as when an abstraction is inlined. If
+        suffix is given, $0 becomes $0-suffix so several inlined copies of
+        one abstraction keep their local names apart. Only objects, atoms,
+        arrays and canvas lines are touched, as Pd does: message boxes keep
+        their $1s.
+
+        >>> c = PdCanvas("0 0 450 300 10")
+        >>> c.add(("#X", "obj", r"10 10 osc~ \$1"))
+        0
+        >>> c.add(("#X", "msg", r"10 40 \$1 50"))
+        1
+        >>> c.add(("#X", "obj", r"10 70 s \$0-freq"))
+        2
+        >>> c.substitute(["440"], "1")
+        >>> for element in c.elements:
+        ...     print(" ".join(element))
+        #X obj 10 10 osc~ 440
+        #X msg 10 40 \$1 50
+        #X obj 10 70 s \$0-1-freq
+        """
+        def fill(match):
+            n = int(match.group(1))
+            if n == 0:
+                return match.group(0) + ("-" + suffix if suffix else "")
+            return args[n - 1] if n <= len(args) else "0"
+
+        self.header = dollarArg.sub(fill, self.header)
+        for i, element in enumerate(self.elements):
+            if isinstance(element, PdCanvas):
+                element.substitute(args, suffix)
+                element.restore = dollarArg.sub(fill, element.restore)
+            else:
+                type, action, elementArgs = element
+                if action in CREATION_ACTIONS:
+                    self.elements[i] = (type, action,
+                                        dollarArg.sub(fill, elementArgs))
+
+    def prune(self, keep=()):
+        """
+        Drop objects without any connection that can't do anything that way:
+        comments, messages, atoms without send or receive names, and objects
+        in INERT_OBJECTS but not in keep. Abstractions, externals and other
+        classes are left alone. Goes through subpatches too and returns how
+        many objects were dropped.
+        """
+        dropped = sum(sub.prune(keep) for sub in self.subpatches())
+        connected = set()
+        for fromObj, outlet, toObj, inlet in self.connections():
+            connected.update((fromObj, toObj))
+        drop = set()
+        for n, position in enumerate(self.objects):
+            element = self.elements[position]
+            if n in connected or isinstance(element, PdCanvas):
+                continue
+            type, action, args = element
+            if action in ("floatatom", "symbolatom", "listbox"):
+                # the last two arguments are the receive and send names
+                if all(a == "-" for a in args.split()[-2:]):
+                    drop.add(position)
+            elif action in ("text", "msg") or (
+                    action == "obj" and self.name(n) in INERT_OBJECTS and
+                    self.name(n) not in keep):
+                drop.add(position)
+        if not drop:
+            return dropped
+
+        renumber, elements, objects = {}, [], []
+        # element position -> object number, for each object
+        numbers = {position: n for n, position in enumerate(self.objects)}
+        skipping = False
+        for position, element in enumerate(self.elements):
+            if position in drop:
+                skipping = True
+                continue
+            # a "#X f" width setting belongs to the object before it
+            if skipping and not isinstance(element, PdCanvas) and \
+                    element[1] == "f":
+                continue
+            skipping = False
+            if position in numbers:
+                renumber[numbers[position]] = len(objects)
+                objects.append(len(elements))
+            elements.append(element)
+        self.elements, self.objects = elements, objects
+        for i, element in enumerate(self.elements):
+            if not isinstance(element, PdCanvas) and element[1] == "connect":
+                fromObj, outlet, toObj, inlet = map(int, element[2].split())
+                self.elements[i] = ("#X", "connect", "{} {} {} {}".format(
+                    renumber[fromObj], outlet, renumber[toObj], inlet))
+        return dropped + len(drop)
+
+    def write(self, writer):
+        """
+        Write this canvas and its subpatches out through a PdWriter.
+        """
+        writer.element("#N", "canvas", self.header)
+        for element in self.elements:
+            if isinstance(element, PdCanvas):
+                element.write(writer)
+            else:
+                writer.element(*element)
+        if self.restore is not None:
+            writer.element("#X", "restore", self.restore)
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,113 @@
+"""
+Merge and rate-limit outbound control messages.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# one default-sized DSP block (64 samples) at 44.1kHz, in seconds
+DEFAULT_WINDOW = 64 / 44100.0
+DEFAULT_MAXLEN = 256
+
+
+class PdCoalescer:
+    """
+    Hold messages back per target and pass them on in batches.
+
+    A message pushed for a target that already has one waiting replaces it
+    (last write wins) and keeps its place in the queue. The waiting messages
+    are handed to `flush` as one list once the oldest of them is `window`
+    seconds old, either from a timer thread or from poll() in an event loop.
+
+    At most `maxlen` targets wait at once. Pushing a new target onto a full
+    queue sends the batch right away in the pushing thread, and other
+    producers block until that send is done, so a bursty producer is slowed
+    down to the rate Pd is fed at instead of growing the queue.
+
+    >>> batches = []
+    >>> c = PdCoalescer(batches.append, window=10, maxlen=2, timer=False)
+    >>> c.push("freq", "freq 100")
+    >>> c.push("gain", "gain 0.5")
+    >>> c.push("freq", "freq 200")
+    >>> c.push("q", "q 3")
+    >>> c.flush()
+    >>> batches
+    [['freq 200', 'gain 0.5'], ['q 3']]
+    >>> c.merged
+    1
+    """
+    def __init__(self, flush, window=DEFAULT_WINDOW, maxlen=DEFAULT_MAXLEN,
+                 timer=True):
+        """
+        flush - called with a list of messages to send.
+        window - seconds a message may wait for newer values of its target.
+        maxlen - most targets allowed to wait at once.
+        timer - flush from a timer thread, otherwise only from poll().
+        """
+        self._flush = flush
+        self.window = window
+        self.maxlen = maxlen
+        self._useTimer = timer
+        self._timer = None
+        self._pending = OrderedDict()
+        self._oldest = None
+        self._lock = threading.RLock()
+        # number of messages dropped because a newer one replaced them
+        self.merged = 0
+
+    def push(self, target, msg):
+        """
+        Queue msg as the latest message for target.
+        """
+        with self._lock:
+            if target in self._pending:
+                self._pending[target] = msg
+                self.merged += 1
+                return
+            if len(self._pending) >= self.maxlen:
+                self._send()
+            self._pending[target] = msg
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                if self._useTimer:
+                    self._timer = threading.Timer(self.window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+    def poll(self):
+        """
+        Send the waiting messages if the oldest has waited a whole window.
+        """
+        with self._lock:
+            if (self._oldest is not None and
+                    time.monotonic() - self._oldest >= self.window):
+                self._send()
+
+    def flush(self):
+        """
+        Send the waiting messages now.
+        """
+        with self._lock:
+            self._send()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _send(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._oldest = None
+        if self._pending:
+            msgs = list(self._pending.values())
+            self._pending.clear()
+            self._flush(msgs)
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
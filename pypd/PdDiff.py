@@ -0,0 +1,176 @@
+"""
+Work out what changed in a Pd file since it was last read, element by element.
+"""
+
+import io
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+from pypd.PdParser import element_re
+from pypd.PdWriter import OBJECT_ACTIONS
+
+# kind is one of "disconnect", "remove", "add", "change", "connect". index is
+# the object number on canvas, or (from, outlet, to, inlet) for connections;
+# element is the element's text and previous what it replaced, for "change".
+PdChange = namedtuple("PdChange", "kind canvas index element previous")
+
+# the order changes must be applied in to turn the old patch into the new one
+KINDS = ["disconnect", "remove", "add", "change", "connect"]
+
+
+class PdIncrementalParser:
+    r"""
+    Keep the elements of a Pd file and, when it's read again, compare the
+    new text with them to find exactly which objects and connections
+    changed. Only elements that differ are tokenized again.
+
+    Changes come in the order of KINDS. Disconnections and removals use the
+    old object numbers, everything else the new ones, so applying them in
+    order to a model of the old patch gives the new one: connections only
+    renumbered because objects came or went before them don't show up.
+
+    >>> p = PdIncrementalParser("x.pd", "#N canvas 0 0 100 100 10;\n"
+    ...     "#X obj 10 10 osc~ 440;\n#X obj 10 40 dac~;\n"
+    ...     "#X connect 0 0 1 0;\n")
+    >>> for c in p.update("#N canvas 0 0 100 100 10;\n"
+    ...         "#X obj 10 10 osc~ 440;\n#X obj 10 25 *~ 0.1;\n"
+    ...         "#X obj 10 40 dac~;\n#X connect 0 0 1 0;\n"
+    ...         "#X connect 1 0 2 0;\n"):
+    ...     print(c.kind, c.canvas, c.index, c.element)
+    disconnect - (0, 0, 1, 0) #X connect 0 0 1 0
+    add - 1 #X obj 10 25 *~ 0.1
+    connect - (0, 0, 1, 0) #X connect 0 0 1 0
+    connect - (1, 0, 2, 0) #X connect 1 0 2 0
+    """
+    def __init__(self, filename, contents=None):
+        """
+        filename - the Pd file to follow.
+        contents - its text, if it has already been read.
+        """
+        self.filename = filename
+        self.elements = []
+        # (type, action, args) for each element
+        self._tokens = []
+        # (canvas path, object number or None) for each element
+        self._numbers = []
+        self.update(contents)
+
+    def _read(self, contents):
+        if contents is None:
+            with io.open(self.filename, "r") as pfile:
+                contents = pfile.read()
+        return [found.group(1) for found in element_re.finditer(contents)]
+
+    @staticmethod
+    def _tokenize(element):
+        bits = element.split(" ", 2)
+        return bits[0], bits[1], bits[2] if len(bits) > 2 else ""
+
+    @staticmethod
+    def _number(tokens):
+        # Canvas path ("-" for the top level, then subpatch names joined by
+        # "/") and object number of each element, numbered the way Pd and
+        # PdParser do it.
+        numbers, canvases, counters, reserved = [], [], [], []
+        for type, action, args in tokens:
+            number, canvas = None, "/".join(canvases[1:]) or "-"
+            if type == "#N" and action == "canvas":
+                bits = args.split(" ")
+                canvases.append(bits[4] if len(bits) == 6 else "")
+                reserved.append(counters[-1] if counters else None)
+                if counters:
+                    counters[-1] += 1
+                counters.append(0)
+            elif type == "#X" and action == "restore":
+                if len(counters) > 1:
+                    canvases.pop()
+                    counters.pop()
+                    number = reserved.pop()
+                    canvas = "/".join(canvases[1:]) or "-"
+            elif type == "#X" and action in OBJECT_ACTIONS and counters:
+                number = counters[-1]
+                counters[-1] += 1
+            numbers.append((canvas, number))
+        return numbers
+
+    def _connections(self, tokens, numbers):
+        found = {}
+        for (type, action, args), (canvas, number) in zip(tokens, numbers):
+            if type == "#X" and action == "connect":
+                found[(canvas, tuple(map(int, args.split())))] = \
+                    "#X connect " + args
+        return found
+
+    def update(self, contents=None):
+        """
+        Read the file again (or take its new contents) and return the list
+        of PdChanges since the last read.
+        """
+        elements = self._read(contents)
+        matcher = SequenceMatcher(None, self.elements, elements,
+                                  autojunk=False)
+        tokens = []
+        # (canvas, old number) -> (canvas, new number) for objects kept
+        kept = {}
+        removed, added, changed = [], [], []
+        opcodes = matcher.get_opcodes()
+        for op, i1, i2, j1, j2 in opcodes:
+            if op == "equal":
+                tokens.extend(self._tokens[i1:i2])
+            else:
+                tokens.extend(self._tokenize(e) for e in elements[j1:j2])
+        numbers = self._number(tokens)
+
+        for op, i1, i2, j1, j2 in opcodes:
+            old = [i for i in range(i1, i2) if self._numbers[i][1] is not None]
+            new = [j for j in range(j1, j2) if numbers[j][1] is not None]
+            if op == "equal":
+                for i, j in zip(old, new):
+                    kept[self._numbers[i]] = numbers[j]
+                continue
+            # objects edited where they stand keep their place and wiring
+            while op == "replace" and old and new and \
+                    self._numbers[old[0]][0] == numbers[new[0]][0]:
+                i, j = old.pop(0), new.pop(0)
+                kept[self._numbers[i]] = numbers[j]
+                changed.append(PdChange("change", numbers[j][0],
+                                        numbers[j][1], elements[j],
+                                        self.elements[i]))
+            removed.extend(PdChange("remove", self._numbers[i][0],
+                                    self._numbers[i][1], self.elements[i],
+                                    None) for i in old)
+            added.extend(PdChange("add", numbers[j][0], numbers[j][1],
+                                  elements[j], None) for j in new)
+
+        oldConnections = self._connections(self._tokens, self._numbers)
+        newConnections = self._connections(tokens, numbers)
+        carried = set()
+        disconnected = []
+        for (canvas, (a, outlet, b, inlet)), element in \
+                sorted(oldConnections.items()):
+            fromObj, toObj = kept.get((canvas, a)), kept.get((canvas, b))
+            moved = (fromObj and toObj and fromObj[0] == toObj[0] and
+                     (fromObj[0], (fromObj[1], outlet, toObj[1], inlet)))
+            if moved and moved in newConnections:
+                carried.add(moved)
+            else:
+                disconnected.append(PdChange("disconnect", canvas,
+                                             (a, outlet, b, inlet), element,
+                                             None))
+        connected = [PdChange("connect", canvas, index, element, None)
+                     for (canvas, index), element
+                     in sorted(newConnections.items())
+                     if (canvas, index) not in carried]
+
+        self.elements, self._tokens, self._numbers = elements, tokens, numbers
+        removed.sort(key=lambda c: (c.canvas, -c.index))
+        added.sort(key=lambda c: (c.canvas, c.index))
+        return disconnected + removed + added + changed + connected
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,81 @@
+"""
+Count the audio trouble Pd reports on stderr.
+"""
+
+import re
+import time
+from collections import Counter, deque
+
+# What Pd prints about audio I/O trouble, in the order lines are checked.
+# Lines of the "audio I/O error history" table end in one of Pd's error
+# type names.
+AUDIO_EVENTS = [
+    ("stuck", re.compile(r"audio I/O stuck")),
+    ("resync", re.compile(r"resync", re.IGNORECASE)),
+    ("dac blocked", re.compile(r"DAC blocked$")),
+    ("adc blocked", re.compile(r"ADC blocked$")),
+    ("sync", re.compile(r"A/D/A sync$")),
+    ("late", re.compile(r"data late$")),
+    ("xrun", re.compile(r"xrun|overrun|underrun", re.IGNORECASE)),
+    ("error", re.compile(r"audio I/O error")),
+]
+
+
+class PdDspMonitor:
+    """
+    Sort Pd's stderr lines about audio dropouts and DSP overload into
+    counters, remembering which operation ran last before each one.
+
+    >>> m = PdDspMonitor()
+    >>> m.mark("start reverb~")
+    >>> m.feed("audio I/O stuck... closing audio")
+    'stuck'
+    >>> m.feed("from-python: hello")
+    >>> m.counts["stuck"], m.byOperation()
+    (1, Counter({'start reverb~': 1}))
+    """
+    def __init__(self, keep=1000):
+        """
+        keep - how many of the latest events to remember in detail.
+        """
+        self.counts = Counter()
+        # (time, kind, line, operation) of the latest events
+        self.events = deque(maxlen=keep)
+        self.operation = None
+        self.operationTime = None
+
+    def mark(self, operation):
+        """
+        Note that operation is about to run, so trouble reported after it
+        can be blamed on it.
+        """
+        self.operation = operation
+        self.operationTime = time.time()
+
+    def feed(self, line):
+        """
+        Classify one line of Pd's stderr. Returns the kind of audio event it
+        reports, or None if it isn't one.
+        """
+        for kind, pattern in AUDIO_EVENTS:
+            if pattern.search(line):
+                self.counts[kind] += 1
+                self.events.append((time.time(), kind, line, self.operation))
+                return kind
+        return None
+
+    def byOperation(self, kinds=None):
+        """
+        Number of remembered events of the given kinds (all by default)
+        following each operation.
+        """
+        return Counter(operation for t, kind, line, operation in self.events
+                       if kinds is None or kind in kinds)
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
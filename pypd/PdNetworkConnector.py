@@ -1,30 +1,109 @@
-from Pd import PdSend, PdReceive, poll
+from pypd.Pd import PdSend, PdReceive, PdReceiveServer, poll
+from pypd.PdProbe import PdLatencyProbe
 
 class PdNetworkConnector:
-	""" Connect to an existing Pd process. """
-	def __init__(self, port=30321):
+	"""
+	Connect to an existing Pd process.
+	
+	With multi=True, any number of Pd processes can connect back instead of
+	just one. Each gets its own connection for Send(), keyed by the address
+	it connected from, and messages without a Pd_xxx method go to
+	PdMessageFrom(source, data). Pass the same map to several connectors to
+	run them all from one Update() loop.
+	
+	Several Pd processes on one host each listen on their own port, which
+	Send() has to reach them at: [python-interface <port>] listens on the
+	one it's given (30321 without one) and announces it with a "port <n>"
+	message on connecting. For Pds that don't, ports maps a source address,
+	or just its host, to the port.
+	"""
+	def __init__(self, port=30321, multi=False, map=None, localaddr=("127.0.0.1", 30322), ports=None):
 		self.port = port
-		self._map = {}
+		self.ports = dict(ports or {})
+		self._map = {} if map is None else map
 		self._pdSend = PdSend(map=self._map)
-		self._pdReceive = PdReceive(self, map=self._map)
+		# source address -> PdSend back to that Pd, and the port it's
+		# connected to, when multi
+		self._pdSends = {}
+		self._sendPorts = {}
+		if multi:
+			self._pdReceive = PdReceiveServer(self, localaddr, map=self._map)
+		else:
+			self._pdReceive = PdReceive(self, localaddr, map=self._map)
+		self._multi = multi
+		self.probe = None
 
 	def Update(self):
 		poll(map=self._map)
+		if self.probe:
+			self.probe.Update()
 	
-	def Send(self, msg):
+	def Send(self, msg, source=None):
 		"""
 		Send an array of data to Pd.
 		It will arrive at the [python-interface] object as a space delimited list.
 		
 		p.Send(["my", "test", "yay"])
+		
+		With multi, the message goes to every connected Pd unless source
+		picks one of them.
+		"""
+		if not self._multi:
+			self._pdSend.Send(msg)
+		elif source is not None:
+			self._pdSends[source].Send(msg)
+		else:
+			for pdSend in self._pdSends.values():
+				pdSend.Send(msg)
+	
+	def Attach(self, source, port=None):
+		"""
+		Open a connection for Send() to a Pd listening on host source[0], at
+		port (or this connector's port), filed under source.
+		"""
+		pdSend = PdSend(map=self._map)
+		pdSend.Connect((source[0], port or self.port))
+		self._pdSends[source] = pdSend
+		self._sendPorts[source] = port or self.port
+		return pdSend
+	
+	def PdConnected(self, source):
+		# until it announces a port, a Pd is taken to listen on the mapped
+		# port, or the connector's
+		self.Attach(source, self.ports.get(source, self.ports.get(source[0])))
+	
+	def Pd_port(self, receiver, data):
+		# a single Pd is reached at self.port, as it always was
+		source, port = receiver.source, int(float(data[0]))
+		if self._multi and self._sendPorts.get(source) != port:
+			if source in self._pdSends:
+				self._pdSends[source].close()
+			self.Attach(source, port)
+	
+	def PdDisconnected(self, source):
+		pdSend = self._pdSends.pop(source, None)
+		self._sendPorts.pop(source, None)
+		if pdSend:
+			pdSend.close()
+	
+	def PdMessageFrom(self, source, data):
+		"""
+		Override this method to receive messages from Pd with their source when multi.
+		"""
+		self.PdMessage(data)
+	
+	def StartProbe(self, interval=1.0, stall=0.25, onStall=None, onRecover=None):
+		"""
+		Start measuring round trips through [python-interface], see PdLatencyProbe.
 		"""
-		self._pdSend.Send(msg)
+		self.probe = PdLatencyProbe(self, interval, stall, onStall, onRecover)
+		return self.probe
 	
 	def PdMessage(self, data):
 		"""
 		Override this method to receive messages from Pd.
 		"""
-		print "untrapped message:", data
+		print("untrapped message:", data)
 	
 	def Connect(self, addr):
 		self._pdSend.Connect((addr[0], self.port))
@@ -40,7 +119,7 @@ class PdNetworkConnector:
 		elif error in self.errorCallbacks:
 			self.errorCallbacks[error]()
 		else:
-			print 'untrapped stderr output: "' + error + '"'
+			print('untrapped stderr output: "' + error + '"')
 
 if __name__ == "__main__":
 	from time import sleep
@@ -6,9 +6,25 @@ Parse Pd files and emit useful information.
 # It started life in the gp2xPd port of Gunter Geiger's PDa
 # The license on this program is LGPLv3
 
+from array import array
+from bisect import bisect_left
 from operator import and_
+import mmap
+import os
 import re
 import io
+import struct
+import sys
+
+from pypd.PdCache import cachePath
+from pypd.PdTrace import span
+from pypd.PdWriter import OBJECT_ACTIONS
+
+element_re = re.compile(r"(#(.*?)[^\\]);\n", re.MULTILINE | re.DOTALL)
+element_bytes_re = re.compile(br"(#(.*?)[^\\]);\n", re.MULTILINE | re.DOTALL)
+# the start of every "#N canvas" (group 2 set) and "#X restore" element
+_marker_re = re.compile(r"(?:^|(?<!\\);\n)(#(N canvas)|#X restore)")
+_marker_bytes_re = re.compile(br"(?:^|(?<!\\);\n)(#(N canvas)|#X restore)")
 
 
 class PdParserException(Exception):
@@ -46,19 +62,27 @@ class PdParser:
     canvasStack: ['patches/parser-test.pd'] type: #X action: obj arguments: 633 213 osc~ 440
     49
     """
-    def __init__(self, filename):
+    def __init__(self, filename, mmap=False):
         """
         >>> p = PdParser("patches/parser-test.pd")
+
+        With mmap=True the file is memory mapped instead of read in, which
+        is the way to go for huge patches, especially together with index().
         """
         # TODO: allow strings as input
         # TODO: allow file-like object as input
-        # TODO: don't read the whole thing in at once, buffer up to each semicolon before parsing one line
-        with io.open(filename, "r") as pfile:
-            self.contents = pfile.read()
+        self.filename = filename
+        if mmap:
+            self.contents = _mapFile(filename)
+        else:
+            with io.open(filename, "r") as pfile:
+                self.contents = pfile.read()
         # the current nested canvas stack
         self.canvas = [filename]
         # list of filters to be applied to the patch
         self.filters = []
+        # object number of the element being filtered, see parse()
+        self.objectIndex = None
 
     def add_filter_method(self, method, **kwargs):
         """
@@ -89,54 +113,518 @@ class PdParser:
         """
         self.filters.append((method, kwargs))
 
-    def parse(self):
+    def parse(self, processes=None):
         """
         Trigger the actual parse.
 
         >>> p = PdParser("patches/parser-test.pd")
         >>> print p.parse(), "elements found"
         49 elements found
+
+        While a filter method runs, self.objectIndex is the number
+        "#X connect" lines use for the element on its canvas (a subpatch's
+        number goes with its "#X restore" line), or None if it isn't an
+        object.
+
+        With processes > 1, a big file is split between its top level
+        subpatches and objects, the pieces are tokenized and filtered in
+        that many processes, and the filter methods are then called in file
+        order as usual.
         """
-        element_re = re.compile(r"(#(.*?)[^\\]);\n", re.MULTILINE | re.DOTALL)
+        with span("parse", "parser", file=self.filename):
+            return self._parse(processes)
+
+    def _parse(self, processes):
+        if processes and processes > 1:
+            chunks = _splitTopLevel(_mapFile(self.filename), processes)
+            if len(chunks) > 1:
+                return self._parseParallel(chunks, processes)
         # how many elements did we find?
         count = 0
+        counters, reserved = [], []
         # look for the kinds of gui elements we know about
-        for found in element_re.finditer(self.contents):
+        for line in self._lines():
+            count += 1
+            self._filter(line, count, counters, reserved)
+        return count
+
+    def _filter(self, line, count, counters, reserved):
+        type, action, object, args = _step(line, count, self.canvas,
+                                           counters, reserved)
+        self.objectIndex = reserved.pop()
+        # go through each of our filters, applying them to this line
+        for method, filter in self.filters:
+            if _matches(filter, self.canvas[-1], type, action, object):
+                method(self.canvas, type, action, args)
+
+    def parseLazily(self, keep=(), pattern=None):
+        r"""
+        Like parse(), but without reading what's inside subpatches, except
+        for those named in keep. Filters still see each skipped subpatch's
+        "#N canvas" and "#X restore" lines, and any element inside that
+        starts with a match for the regular expression pattern (with the
+        canvas stack only going as deep as the skipped subpatch, and
+        objectIndex None).
+
+        Returns {(parent canvas, object number on it): (canvas stack,
+        start, end)} for the skipped subpatches, the parent canvas being
+        its "/" separated path of subpatch names ("-" for the top level);
+        parseRange() reads one later.
+
+        >>> p = PdParser("patches/parser-test.pd")
+        >>> def found(canvasStack, type, action, bits):
+        ...   print(canvasStack[1:], p.objectIndex, bits)
+        >>> p.add_filter_method(found, type="#X", action="obj", object="print")
+        >>> skipped = p.parseLazily(pattern=r"#X obj \d+ \d+ print")
+        ['semicolon-test'] None 10 56 print
+        >>> sorted(skipped)
+        [('-', 1), ('-', 6), ('-', 16)]
+        >>> stack, start, end = skipped["-", 16]
+        >>> p.filters = []
+        >>> p.add_filter_method(found, type="#X", action="msg")
+        >>> p.parseRange(start, end, stack)
+        ['semicolon-test'] 0 10 18 this is a message box \, with comments \, and also \;
+        semicolons! yes it is. it's like this: yo. test \; test \; test \;
+        <BLANKLINE>
+        3
+        """
+        contents = self.contents
+        if isinstance(contents, str):
+            elements, markers = element_re, _marker_re
+        else:
+            elements, markers = element_bytes_re, _marker_bytes_re
+            if isinstance(pattern, str):
+                pattern = pattern.encode("utf-8")
+        if pattern is not None:
+            pattern = re.compile(pattern)
+        # where each "#N canvas" line's subpatch ends
+        restores, stack = {}, []
+        for m in markers.finditer(contents):
+            if m.group(2):
+                stack.append(m.start(1))
+            elif stack:
+                restores[stack.pop()] = m.start(1)
+        count, pos, skipped = 0, 0, {}
+        counters, reserved = [], []
+        while True:
+            found = elements.search(contents, pos)
+            if not found:
+                break
             count += 1
-            line = found.group(1)
-            bits = line.split(" ")
-            # pd command type as designated by #N, #X, etc.
-            type = bits.pop(0)
-            # the 'action' field
-            action = bits.pop(0)
-            # the 'object' field
-            object = bits[2] if len(bits) >= 3 else ""
-
-            # check that the 'type' field is valid
-            if not len(type) == 2 or not type[0] == "#":
-                raise PdParserException(
-                    "Type did not begin with '#' at element " + count)
-
-            # see if our canvas stack is down a level
-            if type == "#N":
-                if len(bits) == 6 and action == "canvas":
-                    self.canvas.append(bits[4])
-
-            # see if our canvas stack goes up a level
-            if type == "#X":
-                if len(bits) >= 3 and action == "restore":
-                    self.canvas.pop()
-
-            # go through each of our filters, applying them to this line
-            for method, filter in self.filters:
-                testFilters = [("canvas", self.canvas[-1]),
-                               ("type", type),
-                               ("action", action),
-                               ("object", object)]
-                if all(filter.get(f, t) == t for f, t in testFilters):
-                    method(self.canvas, type, action, " ".join(bits))
+            self._filter(_text(found.group(1)), count, counters, reserved)
+            pos = found.end()
+            restore = restores.get(found.start(1))
+            if (restore is None or len(counters) < 2 or
+                    self.canvas[-1] in keep):
+                continue
+            # reserved[-1] is the subpatch's number on its parent
+            parent = "/".join(self.canvas[1:-1]) or "-"
+            skipped[parent, reserved[-1]] = (list(self.canvas), pos, restore)
+            if pattern is not None:
+                for match in pattern.finditer(contents, pos, restore):
+                    element = elements.match(contents, match.start())
+                    if element:
+                        self._filterUnnumbered(_text(element.group(1)))
+            pos = restore
+        return skipped
+
+    def _filterUnnumbered(self, line):
+        bits = line.split(" ")
+        type, action = bits[0], bits[1]
+        object = bits[4] if len(bits) >= 5 else ""
+        self.objectIndex = None
+        for method, filter in self.filters:
+            if _matches(filter, self.canvas[-1], type, action, object):
+                method(self.canvas, type, action, " ".join(bits[2:]))
+
+    def parseRange(self, start, end, canvasStack):
+        """
+        Run the filters over the contents of a subpatch parseLazily()
+        skipped, given as it returned it. Objects are numbered on the
+        subpatch from 0, as usual. Returns the number of elements.
+        """
+        elements = (element_re if isinstance(self.contents, str)
+                    else element_bytes_re)
+        self.canvas[:] = canvasStack
+        count, counters, reserved = 0, [0], []
+        try:
+            for found in elements.finditer(self.contents, start, end):
+                count += 1
+                self._filter(_text(found.group(1)), count, counters, reserved)
+        finally:
+            self.canvas[:] = [self.filename]
         return count
 
+    def _parseParallel(self, chunks, processes):
+        from concurrent.futures import ProcessPoolExecutor
+
+        filters = [filter for method, filter in self.filters]
+        with ProcessPoolExecutor(processes) as pool:
+            results = pool.map(_parseChunk,
+                               [(self.filename, start, end, first, filters)
+                                for first, (start, end) in enumerate(chunks)])
+            count, topObjects = 0, 0
+            for chunkCount, chunkTopObjects, found in results:
+                for stack, type, action, args, objectIndex, top, matched in found:
+                    if top and objectIndex is not None:
+                        objectIndex += topObjects
+                    self.objectIndex = objectIndex
+                    self.canvas[:] = [self.filename] + stack
+                    for f in matched:
+                        self.filters[f][0](self.canvas, type, action, args)
+                count += chunkCount
+                topObjects += chunkTopObjects
+        self.canvas[:] = [self.filename]
+        return count
+
+    def _lines(self):
+        if isinstance(self.contents, str):
+            for found in element_re.finditer(self.contents):
+                yield found.group(1)
+        else:
+            for found in element_bytes_re.finditer(self.contents):
+                yield found.group(1).decode("utf-8")
+
+    def index(self):
+        """
+        Build a PdElementIndex of where each element of the file starts and
+        ends.
+
+        >>> i = PdParser("patches/parser-test.pd", mmap=True).index()
+        >>> len(i), i.element(i.object(0, 17))
+        (49, '#X obj 633 213 osc~ 440')
+        """
+        return PdElementIndex.build(self.filename, self.contents)
+
+
+def _text(element):
+    return element if isinstance(element, str) else element.decode("utf-8")
+
+
+def _matches(filter, canvas, type, action, object):
+    testFilters = [("canvas", canvas),
+                   ("type", type),
+                   ("action", action),
+                   ("object", object)]
+    return all(filter.get(f, t) == t for f, t in testFilters)
+
+
+def _step(line, count, canvas, counters, reserved):
+    # Tokenize one element and keep track of the canvas stack and of object
+    # numbering on each open canvas. Leaves the element's object number
+    # (or None) on top of reserved for the caller to pop.
+    bits = line.split(" ")
+    # pd command type as designated by #N, #X, etc.
+    type = bits.pop(0)
+    # the 'action' field
+    action = bits.pop(0)
+    # the 'object' field
+    object = bits[2] if len(bits) >= 3 else ""
+
+    # check that the 'type' field is valid
+    if not len(type) == 2 or not type[0] == "#":
+        raise PdParserException(
+            "Type did not begin with '#' at element " + str(count))
+
+    number = None
+    # see if our canvas stack is down a level
+    if type == "#N" and action == "canvas":
+        if len(bits) == 6:
+            canvas.append(bits[4])
+        # a subpatch is numbered on its parent before its own contents
+        reserved.append(counters[-1] if counters else None)
+        if counters:
+            counters[-1] += 1
+        counters.append(0)
+    # see if our canvas stack goes up a level
+    elif type == "#X" and action == "restore":
+        if len(bits) >= 3:
+            canvas.pop()
+        if len(counters) > 1:
+            counters.pop()
+            number = reserved.pop()
+    elif type == "#X" and action in OBJECT_ACTIONS and counters:
+        number = counters[-1]
+        counters[-1] += 1
+    reserved.append(number)
+    return type, action, object, " ".join(bits)
+
+
+def _splitTopLevel(contents, pieces):
+    # Byte ranges covering contents, about len/pieces long each, that only
+    # start at elements on the top level canvas.
+    events = [(m.start(1), m.group(1) == b"#N canvas") for m in re.finditer(
+        br"(?:^|(?<!\\);\n)(#N canvas|#X restore)", contents)]
+    depth, depths = 0, []
+    for offset, opens in events:
+        depth += 1 if opens else -1
+        depths.append(depth)
+    offsets = [offset for offset, opens in events]
+    chunks, start = [], 0
+    for piece in range(1, pieces):
+        target = max(len(contents) * piece // pieces, start)
+        # the next element boundary at or after target...
+        boundary = contents.find(b";\n#", target)
+        while boundary > 0 and contents[boundary - 1:boundary] == b"\\":
+            boundary = contents.find(b";\n#", boundary + 1)
+        if boundary < 0:
+            break
+        boundary += 2
+        # ...moved past the end of any subpatch it falls inside of
+        event = bisect_left(offsets, boundary) - 1
+        while event < len(events) and depths[event] != 1:
+            event += 1
+        if event == len(events):
+            break
+        if offsets[event] >= boundary:
+            boundary = contents.find(b";\n", offsets[event]) + 2
+        if start < boundary < len(contents):
+            chunks.append((start, boundary))
+            start = boundary
+    chunks.append((start, len(contents)))
+    return chunks
+
+
+def _parseChunk(job):
+    filename, start, end, first, filters = job
+    contents = _mapFile(filename)
+    canvas, found, count = [filename], [], 0
+    # every chunk after the first starts out on the top level canvas
+    counters, reserved = ([], []) if first == 0 else ([0], [])
+    for m in element_bytes_re.finditer(contents, start, end):
+        count += 1
+        type, action, object, args = _step(m.group(1).decode("utf-8"), count,
+                                           canvas, counters, reserved)
+        number = reserved.pop()
+        matched = [i for i, filter in enumerate(filters)
+                   if _matches(filter, canvas[-1], type, action, object)]
+        if matched:
+            found.append((canvas[1:], type, action, args, number,
+                          len(counters) == 1, matched))
+    return count, counters[0] if counters else 0, found
+
+
+def _mapFile(filename):
+    with io.open(filename, "rb") as pfile:
+        if not os.fstat(pfile.fileno()).st_size:
+            return b""
+        return mmap.mmap(pfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PdElementIndex:
+    """
+    Byte offsets of every element in a Pd file, for reading any element or
+    subpatch straight from a memory mapped file without parsing the rest.
+
+    Element i spans bytes starts[i] to ends[i] (the ";" and newline
+    included) and sits depths[i] canvases deep: the top level "#N canvas"
+    line is at depth 0 and the objects on the top level canvas at depth 1.
+    canvases[i] is the canvas it belongs to, numbered in order of their
+    "#N canvas" lines from 0 for the top level, or -1 for the top level
+    header itself.
+
+    Object n of canvas c, as "#X connect" lines count them, is element
+    object(c, n). For a subpatch that's its "#N canvas" line, and
+    objectRange(c, n) covers the whole subpatch up to its "#X restore".
+
+    Saved indexes hold fixed width little endian numbers, so one saved on
+    any platform reads the same on any other.
+
+    >>> import shutil, tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> patch = shutil.copy("patches/parser-test.pd", d)
+    >>> PdParser(patch, mmap=True).index().save()
+    >>> i = PdElementIndex.load(patch); i.element(i.object(0, 17))
+    '#X obj 633 213 osc~ 440'
+    >>> with open(cachePath(patch, ".idx"), "r+b") as indexFile:
+    ...     _ = indexFile.truncate(100)
+    >>> i = PdElementIndex.load(patch); i.element(i.object(0, 17))
+    '#X obj 633 213 osc~ 440'
+    >>> os.path.getsize(cachePath(patch, ".idx")) > 100
+    True
+    >>> shutil.rmtree(d)
+    """
+    MAGIC = b"PdElementIndex2\n"
+    # file size, file mtime in ns, number of elements, number of canvases
+    HEADER = struct.Struct("<qqqq")
+
+    def __init__(self, filename, contents=None):
+        self.filename = filename
+        self.contents = contents if contents is not None else _mapFile(
+            filename)
+        self.starts = array("q")
+        self.ends = array("q")
+        self.depths = array("H")
+        self.canvases = array("q")
+        # element index of each canvas' "#N canvas" and "#X restore" lines
+        self.canvasStarts = array("q")
+        self.canvasEnds = array("q")
+        # element index of each numbered object, per canvas
+        self.objects = []
+
+    @classmethod
+    def build(cls, filename, contents=None):
+        index = cls(filename, contents)
+        contents = index.contents
+        if isinstance(contents, str):
+            contents = contents.encode("utf-8")
+        stack = []
+        for found in element_bytes_re.finditer(contents):
+            i = len(index.starts)
+            type, action = found.group(1).split(None, 2)[:2]
+            index.starts.append(found.start())
+            index.ends.append(found.end())
+            if type == b"#X" and action == b"restore" and len(stack) > 1:
+                index.canvasEnds[stack.pop()] = i
+            canvas = stack[-1] if stack else -1
+            index.depths.append(len(stack))
+            index.canvases.append(canvas)
+            if type == b"#N" and action == b"canvas":
+                if stack:
+                    index.objects[canvas].append(i)
+                stack.append(len(index.canvasStarts))
+                index.canvasStarts.append(i)
+                index.canvasEnds.append(-1)
+                index.objects.append(array("q"))
+            elif (type == b"#X" and action.decode() in OBJECT_ACTIONS and
+                    action != b"restore" and stack):
+                index.objects[canvas].append(i)
+        if stack:
+            index.canvasEnds[stack[0]] = len(index.starts) - 1
+        if isinstance(index.contents, str):
+            index.contents = contents
+        return index
+
+    def __len__(self):
+        return len(self.starts)
+
+    def element(self, i):
+        """
+        Text of element i, without its terminating semicolon.
+        """
+        # leave off the terminating ";\n"
+        return self.contents[self.starts[i]:self.ends[i] - 2].decode("utf-8")
+
+    def tokens(self, i):
+        """
+        (type, action, args) of element i, as PdParser filters see them.
+        """
+        bits = self.element(i).split(" ")
+        return bits[0], bits[1], " ".join(bits[2:])
+
+    def object(self, canvas, n):
+        return self.objects[canvas][n]
+
+    def objectRange(self, canvas, n):
+        """
+        (start, end) byte offsets of object n on canvas.
+        """
+        i = self.object(canvas, n)
+        sub = bisect_left(self.canvasStarts, i)
+        if sub < len(self.canvasStarts) and self.canvasStarts[sub] == i:
+            return self.canvasRange(sub)
+        return self.starts[i], self.ends[i]
+
+    def canvasRange(self, canvas):
+        """
+        (start, end) byte offsets of a whole canvas, header to restore.
+        """
+        return (self.starts[self.canvasStarts[canvas]],
+                self.ends[self.canvasEnds[canvas]])
+
+    def _stamp(self):
+        stat = os.stat(self.filename)
+        return stat.st_size, stat.st_mtime_ns
+
+    def save(self, filename=None):
+        """
+        Store the index, in the cache directory by default (see
+        pypd.PdCache).
+        """
+        filename = filename or cachePath(self.filename, ".idx")
+        size, mtime = self._stamp()
+        with io.open(filename, "wb") as indexFile:
+            indexFile.write(self.MAGIC)
+            indexFile.write(self.HEADER.pack(size, mtime, len(self),
+                                             len(self.objects)))
+            for a in (self.starts, self.ends, self.depths, self.canvases,
+                      self.canvasStarts, self.canvasEnds):
+                _writeArray(a, indexFile)
+            _writeArray(array("q", (len(o) for o in self.objects)), indexFile)
+            for o in self.objects:
+                _writeArray(o, indexFile)
+
+    @classmethod
+    def load(cls, filename, indexFilename=None):
+        """
+        Load the index saved for a patch. If there's none, or it's out of
+        date, short or corrupt, build a new one and save that instead.
+        """
+        indexFilename = indexFilename or cachePath(filename, ".idx")
+        try:
+            index = cls._load(filename, indexFilename)
+        except (IOError, EOFError, ValueError, struct.error):
+            index = None
+        if index is None:
+            index = cls.build(filename)
+            try:
+                index.save(indexFilename)
+            except IOError:
+                # a read-only directory just means rebuilding every time
+                pass
+        return index
+
+    @classmethod
+    def _load(cls, filename, indexFilename):
+        # the saved index, None if it's out of date, raising EOFError or
+        # ValueError if it's short or corrupt
+        index = cls(filename)
+        with io.open(indexFilename, "rb") as indexFile:
+            if indexFile.read(len(cls.MAGIC)) != cls.MAGIC:
+                return None
+            size, mtime, elements, canvases = cls.HEADER.unpack(
+                indexFile.read(cls.HEADER.size))
+            if (size, mtime) != index._stamp():
+                return None
+            if not 0 <= canvases <= elements <= size:
+                raise ValueError("bad element or canvas count")
+            index.starts = _readArray("q", indexFile, elements)
+            index.ends = _readArray("q", indexFile, elements)
+            index.depths = _readArray("H", indexFile, elements)
+            index.canvases = _readArray("q", indexFile, elements)
+            index.canvasStarts = _readArray("q", indexFile, canvases)
+            index.canvasEnds = _readArray("q", indexFile, canvases)
+            counts = _readArray("q", indexFile, canvases)
+            if sum(counts) > elements or min(counts, default=0) < 0:
+                raise ValueError("bad object count")
+            index.objects = [_readArray("q", indexFile, n) for n in counts]
+            if indexFile.read(1):
+                raise ValueError("trailing data")
+        if any(start < 0 or end > size for start, end in
+               zip(index.starts, index.ends)):
+            raise ValueError("offset past the end of the patch")
+        return index
+
+
+def _writeArray(a, outFile):
+    # always stored little endian
+    if sys.byteorder == "big":
+        a = array(a.typecode, a)
+        a.byteswap()
+    a.tofile(outFile)
+
+
+def _readArray(typecode, inFile, n):
+    # n items saved by _writeArray, or EOFError if the file is short
+    a = array(typecode)
+    data = inFile.read(n * a.itemsize)
+    if len(data) < n * a.itemsize:
+        raise EOFError("index file is truncated")
+    a.frombytes(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
 
 def _test():
     import doctest
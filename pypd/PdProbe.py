@@ -0,0 +1,118 @@
+"""
+Measure how quickly Pd's message loop answers.
+"""
+
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+# Pd prints floats with %g, six significant digits, so from 1000000 on a
+# number comes back as "1e+06" or "1.23457e+06" and no longer matches what
+# was sent. Keep sequence numbers below that (well inside the 2 ** 24 Pd
+# floats count exactly up to).
+SEQUENCE_WRAP = 10 ** 6
+
+
+class PdLatencyProbe:
+    """
+    Ping Pd regularly and keep a histogram of the round trip times.
+
+    Every `interval` seconds a "ping <n>" message goes to the
+    [python-interface] abstraction, which sends it straight back as
+    "pong <n>". Round trips go into buckets doubling in size from 0.1ms up,
+    so percentiles are accurate to a factor of two and memory use stays
+    fixed however long the probe runs.
+
+    When the oldest unanswered ping has waited `stall` seconds, onStall is
+    called once with how long it has waited. When pongs come back after a
+    stall, onRecover is called with the round trip of the late one. While
+    Pd is stalled or gone, only the latest MAX_OUTSTANDING pings are
+    remembered, and pongs for older ones are ignored.
+
+    Call Update() from the same loop that calls the connection's Update();
+    Pd.StartProbe() and PdNetworkConnector.StartProbe() set that up.
+    """
+    BUCKETS = [0.0001 * 2 ** k for k in range(20)]
+    MAX_OUTSTANDING = 64
+
+    def __init__(self, connection, interval=1.0, stall=0.25, onStall=None,
+                 onRecover=None):
+        """
+        connection - a Pd or PdNetworkConnector to ping.
+        interval - seconds between pings.
+        stall - seconds without an answer before Pd counts as stalled.
+        """
+        self.connection = connection
+        self.interval = interval
+        self.stall = stall
+        self.onStall = onStall
+        self.onRecover = onRecover
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0
+        self.worst = 0.0
+        self.stalls = 0
+        self.stalled = False
+        self._sequence = 0
+        # sequence number -> time sent, for pings not answered yet, oldest
+        # first
+        self._outstanding = OrderedDict()
+        self._nextPing = time.monotonic()
+        # PdReceive hands "pong ..." messages to Pd_pong(receiver, data)
+        connection.Pd_pong = self._pong
+
+    def Update(self):
+        now = time.monotonic()
+        if now >= self._nextPing:
+            self._sequence = (self._sequence + 1) % SEQUENCE_WRAP
+            self._outstanding[self._sequence] = now
+            if len(self._outstanding) > self.MAX_OUTSTANDING:
+                self._outstanding.popitem(last=False)
+            self.connection.Send(["ping", self._sequence])
+            self._nextPing = now + self.interval
+        if self._outstanding and not self.stalled:
+            waited = now - min(self._outstanding.values())
+            if waited >= self.stall:
+                self.stalled = True
+                self.stalls += 1
+                if self.onStall:
+                    self.onStall(waited)
+
+    def _pong(self, receiver, data):
+        sent = self._outstanding.pop(int(float(data[0])), None)
+        if sent is None:
+            return
+        latency = time.monotonic() - sent
+        self.counts[bisect_left(self.BUCKETS, latency)] += 1
+        self.total += 1
+        self.worst = max(self.worst, latency)
+        # anything sent before this ping and still missing won't come back
+        for sequence, then in list(self._outstanding.items()):
+            if then < sent:
+                del self._outstanding[sequence]
+        if self.stalled and not self._outstanding:
+            self.stalled = False
+            if self.onRecover:
+                self.onRecover(latency)
+
+    def percentile(self, p):
+        """
+        Round trip time in seconds that p percent of pings came in under,
+        rounded up to the end of its histogram bucket. None before any pong.
+        """
+        if not self.total:
+            return None
+        wanted = self.total * p / 100.0
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return self.worst
+
+    @property
+    def p50(self):
+        return self.percentile(50)
+
+    @property
+    def p99(self):
+        return self.percentile(99)
@@ -0,0 +1,114 @@
+"""
+Record the FUDI messages going to and coming from Pd, and play them back.
+"""
+
+import struct
+import threading
+import time
+
+MAGIC = b"PDREC\x01"
+# monotonic nanoseconds, direction, payload length
+RECORD = struct.Struct("<QBI")
+OUT, IN = 0, 1
+
+
+class PdRecorder:
+    """
+    Append every message sent to or received from Pd to a compact binary
+    log: MAGIC, then for each message a RECORD header followed by the
+    message exactly as it went over the wire.
+
+    Pd.Record() and pd.record() hook one of these into their connections.
+
+    >>> import io
+    >>> log = io.BytesIO()
+    >>> r = PdRecorder(log)
+    >>> r.record(OUT, b"ping 1;\\n")
+    >>> r.record(IN, b"pong 1;\\n")
+    >>> _ = log.seek(0)
+    >>> [(d, p) for t, d, p in readRecording(log)]
+    [(0, b'ping 1;\\n'), (1, b'pong 1;\\n')]
+    """
+    def __init__(self, out):
+        """
+        out - a filename, or a binary file object open for writing.
+        """
+        self._owned = isinstance(out, str)
+        self.out = open(out, "wb") if self._owned else out
+        self.out.write(MAGIC)
+        self.count = 0
+        # messages can come from the event loop and from timer threads
+        self._lock = threading.Lock()
+
+    def record(self, direction, payload):
+        header = RECORD.pack(time.monotonic_ns(), direction, len(payload))
+        with self._lock:
+            self.out.write(header + payload)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._owned:
+                self.out.close()
+            else:
+                self.out.flush()
+
+
+def readRecording(source):
+    """
+    Yield (monotonic ns, direction, payload) for each message in a recording,
+    given its filename or a binary file object.
+    """
+    recording = open(source, "rb") if isinstance(source, str) else source
+    try:
+        if recording.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a Pd message recording")
+        while True:
+            header = recording.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, length = RECORD.unpack(header)
+            yield timestamp, direction, recording.read(length)
+    finally:
+        if recording is not source:
+            recording.close()
+
+
+def replay(source, send, speed=1.0, direction=OUT):
+    """
+    Hand the payloads recorded in one direction to send(payload), keeping
+    their original spacing divided by speed, or as fast as possible if
+    speed is 0. Returns the number of messages sent.
+
+    >>> sent = []
+    >>> import io
+    >>> log = io.BytesIO()
+    >>> r = PdRecorder(log)
+    >>> r.record(OUT, b"a;\\n"); r.record(IN, b"b;\\n"); r.record(OUT, b"c;\\n")
+    >>> _ = log.seek(0)
+    >>> replay(log, sent.append, speed=0), sent
+    (2, [b'a;\\n', b'c;\\n'])
+    """
+    start = first = None
+    count = 0
+    for timestamp, recorded, payload in readRecording(source):
+        if recorded != direction:
+            continue
+        if speed:
+            if first is None:
+                first, start = timestamp, time.monotonic_ns()
+            wait = ((timestamp - first) / speed -
+                    (time.monotonic_ns() - start)) / 1e9
+            if wait > 0:
+                time.sleep(wait)
+        send(payload)
+        count += 1
+    return count
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
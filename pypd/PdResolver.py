@@ -0,0 +1,211 @@
+"""
+Follow abstractions used by Pd patches to the files that define them.
+"""
+
+import json
+import os
+
+from pypd.PdParser import PdParser
+
+
+class PdResolver:
+    """
+    Resolve the abstractions used by Pd patches and cache the dependency graph.
+
+    Abstractions are looked up the way Pd does it: in the directory of the
+    patch using them, then in its [declare -path] directories, then along the
+    search path (the same list passed to Pd with -path). Each file is only
+    parsed again when its modification time changes, and a change only
+    throws away the cached closures of the patches that depend on it.
+
+    >>> r = PdResolver(["patches"])
+    >>> r.closure("patches/python-interface-help.pd")
+    {'patches/python-interface.pd'}
+    >>> r.unresolved("patches/python-interface-help.pd")
+    ['tgl', 'print', 'route', 't', 's', 'r', 'sel']
+    """
+    def __init__(self, path=()):
+        """
+        path - directories to search after the patch's own directory.
+        """
+        self.path = list(path)
+        # filename -> mtime, object names in order of use, declared paths
+        self._scanned = {}
+        # filename -> resolved abstraction files, names that didn't resolve
+        self._resolved = {}
+        # filename -> every file it depends on, directly or not
+        self._closures = {}
+        self._dirMtimes = {}
+
+    def _mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def _scan(self, filename):
+        names, declared = [], []
+
+        def found_obj(canvasStack, type, action, args):
+            bits = args.split()
+            if len(bits) < 3:
+                return
+            if bits[2] == "declare":
+                found_declare(canvasStack, type, action, " ".join(bits[3:]))
+            elif bits[2] not in names and "$" not in bits[2]:
+                names.append(bits[2])
+
+        def found_declare(canvasStack, type, action, args):
+            bits = args.split()
+            declared.extend(d for flag, d in zip(bits, bits[1:])
+                            if flag == "-path")
+
+        p = PdParser(filename)
+        p.add_filter_method(found_obj, type="#X", action="obj")
+        p.add_filter_method(found_declare, type="#X", action="declare")
+        p.parse()
+        return names, declared
+
+    def _searchPath(self, filename, declared):
+        here = os.path.dirname(filename)
+        return ([here] + [os.path.join(here, d) for d in declared] +
+                self.path)
+
+    def _checkDirs(self):
+        # A file appearing or disappearing anywhere on the search path may
+        # change what a name resolves to, but doesn't need a re-parse.
+        dirs = set(self.path)
+        dirs.update(os.path.dirname(f) for f in self._scanned)
+        mtimes = {d: self._mtime(d) for d in dirs}
+        if mtimes != self._dirMtimes:
+            self._dirMtimes = mtimes
+            self._resolved.clear()
+            self._closures.clear()
+
+    def _refresh(self, filename):
+        # Returns True if filename had to be parsed again.
+        mtime = self._mtime(filename)
+        cached = self._scanned.get(filename)
+        if cached and cached[0] == mtime:
+            return False
+        names, declared = self._scan(filename) if mtime else ([], [])
+        self._scanned[filename] = (mtime, names, declared)
+        self._resolved.pop(filename, None)
+        for root, members in list(self._closures.items()):
+            if root == filename or filename in members:
+                del self._closures[root]
+        return True
+
+    def _lookup(self, name, search):
+        for d in search:
+            candidate = os.path.normpath(os.path.join(d, name + ".pd"))
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+
+    def _resolve(self, filename):
+        self._refresh(filename)
+        if filename not in self._resolved:
+            mtime, names, declared = self._scanned[filename]
+            found, missing = [], []
+            search = self._searchPath(filename, declared)
+            for name in names:
+                candidate = self._lookup(name, search)
+                if candidate is None:
+                    missing.append(name)
+                elif candidate not in found:
+                    found.append(candidate)
+            self._resolved[filename] = (found, missing)
+        return self._resolved[filename]
+
+    def find(self, name, filename):
+        """
+        The file an object called name in filename would load, or None.
+        """
+        filename = os.path.normpath(filename)
+        self._refresh(filename)
+        mtime, names, declared = self._scanned[filename]
+        return self._lookup(name, self._searchPath(filename, declared))
+
+    def dependencies(self, filename):
+        """
+        The abstraction files filename uses directly.
+        """
+        self._checkDirs()
+        return list(self._resolve(os.path.normpath(filename))[0])
+
+    def unresolved(self, filename):
+        """
+        Object names in filename that aren't abstractions on the search path:
+        Pd's built in objects, externals and missing abstractions.
+        """
+        self._checkDirs()
+        return list(self._resolve(os.path.normpath(filename))[1])
+
+    def graph(self, filename):
+        """
+        Map of filename and every file it depends on to the files each uses
+        directly.
+        """
+        self._checkDirs()
+        graph = {}
+        todo = [os.path.normpath(filename)]
+        while todo:
+            f = todo.pop()
+            if f not in graph:
+                graph[f] = self._resolve(f)[0]
+                todo.extend(graph[f])
+        return graph
+
+    def closure(self, filename):
+        """
+        Every abstraction file filename depends on, directly or not.
+        """
+        filename = os.path.normpath(filename)
+        self._checkDirs()
+        members = self._closures.get(filename)
+        if members is not None:
+            # Only re-walk if something in this subtree changed on disk
+            if not any(self._refresh(f) for f in [filename] + list(members)):
+                return set(members)
+        graph = self.graph(filename)
+        members = frozenset(graph) - {filename}
+        self._closures[filename] = members
+        return set(members)
+
+    def library(self, directory):
+        """
+        Dependency graph of every patch in directory.
+        """
+        graph = {}
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".pd"):
+                graph.update(self.graph(os.path.join(directory, name)))
+        return graph
+
+    def save(self, filename):
+        """
+        Write the parse cache to filename so a later run can start from it.
+        """
+        with open(filename, "w") as cacheFile:
+            json.dump({f: list(entry) for f, entry in self._scanned.items()},
+                      cacheFile, separators=(",", ":"))
+
+    def load(self, filename):
+        """
+        Read a parse cache written by save(). Entries for files changed
+        since are parsed again when they are next needed.
+        """
+        with open(filename) as cacheFile:
+            for f, (mtime, names, declared) in json.load(cacheFile).items():
+                self._scanned[f] = (mtime, names, declared)
+        self._resolved.clear()
+        self._closures.clear()
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,111 @@
+"""
+Record what the patch bay spends its time on as a Chrome trace.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# the tracer recording right now, if any; see start()
+tracer = None
+
+
+class PdTracer:
+    """
+    Collect timed spans and instant events, and write them out in the
+    Chrome trace event format that chrome://tracing and Perfetto open.
+
+    >>> t = PdTracer()
+    >>> with t.span("parse", "parser", file="x.pd"):
+    ...     t.instant("send", "pd", message="obj 10 10 osc~")
+    >>> [(e["name"], e["ph"]) for e in t.events]
+    [('send', 'i'), ('parse', 'X')]
+    """
+    def __init__(self):
+        self.events = []
+        self._start = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def _now(self):
+        return (time.perf_counter_ns() - self._start) / 1000.0
+
+    def _add(self, event):
+        event.update(pid=os.getpid(), tid=threading.get_ident())
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category, **args):
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._add({"name": name, "cat": category, "ph": "X", "ts": start,
+                       "dur": self._now() - start, "args": args})
+
+    def instant(self, name, category, **args):
+        self._add({"name": name, "cat": category, "ph": "i", "s": "t",
+                   "ts": self._now(), "args": args})
+
+    def save(self, filename):
+        with self._lock:
+            events = sorted(self.events, key=lambda e: e["ts"])
+        with open(filename, "w") as traceFile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"},
+                      traceFile)
+
+
+def start():
+    """Start recording into a new PdTracer, which is returned."""
+    global tracer
+    tracer = PdTracer()
+    return tracer
+
+
+def stop(filename=None):
+    """Stop recording, saving the trace to filename if given."""
+    global tracer
+    stopped, tracer = tracer, None
+    if stopped and filename:
+        stopped.save(filename)
+    return stopped
+
+
+@contextmanager
+def span(name, category, **args):
+    """Time the block as a span if tracing is on; costs next to nothing if
+    it isn't."""
+    if tracer is None:
+        yield
+    else:
+        with tracer.span(name, category, **args):
+            yield
+
+
+def instant(name, category, **args):
+    if tracer is not None:
+        tracer.instant(name, category, **args)
+
+
+def traced(category):
+    """Decorate a method so each call is a span named after it."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return method(*args, **kwargs)
+            with tracer.span(method.__name__, category):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,120 @@
+"""
+Write Pd files element by element.
+"""
+
+# Element actions Pd numbers as objects, in the order they appear on a canvas
+OBJECT_ACTIONS = frozenset([
+    "obj", "msg", "floatatom", "symbolatom", "listbox", "text", "restore",
+    "scalar",
+])
+
+
+def escape(atom):
+    r"""
+    Turn a Python value into a Pd atom, escaping characters Pd treats
+    specially.
+
+    >>> print(escape("$0-buf"), escape(0.5), escape("a;b, c"))
+    \$0-buf 0.5 a\;b\,\ c
+    """
+    if isinstance(atom, float):
+        return "{:g}".format(atom)
+    atom = str(atom)
+    for c in "$;, ":
+        atom = atom.replace(c, "\\" + c)
+    return atom
+
+
+class PdWriter:
+    """
+    Stream a Pd file out one element at a time, the counterpart of PdParser.
+
+    The writer keeps track of canvases opened and restored, and hands back
+    the number Pd will give each object so connections can be made to it.
+
+    >>> import io
+    >>> out = io.StringIO()
+    >>> w = PdWriter(out)
+    >>> w.canvas(0, 50, 450, 300)
+    >>> osc = w.obj(10, 10, "osc~", 440)
+    >>> w.canvas(0, 50, 450, 300, "gain")
+    >>> inlet = w.obj(10, 10, "inlet~")
+    >>> w.restore(10, 40, "pd", "gain")
+    1
+    >>> w.connect(osc, 0, 1, 0)
+    >>> print(out.getvalue().strip())
+    #N canvas 0 50 450 300 10;
+    #X obj 10 10 osc~ 440;
+    #N canvas 0 50 450 300 gain 0;
+    #X obj 10 10 inlet~;
+    #X restore 10 40 pd gain;
+    #X connect 0 0 1 0;
+    """
+    def __init__(self, out):
+        """
+        out - a file-like object open for writing text.
+        """
+        self.out = out
+        # objects numbered so far on each open canvas, innermost last
+        self._counts = []
+
+    def element(self, type, action, args=""):
+        """
+        Write one element. args must already be in Pd's escaped form, as
+        handed out by PdParser filters.
+
+        Returns the element's object number on its canvas, or None if it
+        isn't an object.
+        """
+        if type == "#X" and action == "restore":
+            self._counts.pop()
+        self.out.write(" ".join(p for p in (type, action, args) if p) + ";\n")
+        number = None
+        if type == "#X" and action in OBJECT_ACTIONS and self._counts:
+            number = self._counts[-1]
+            self._counts[-1] += 1
+        if type == "#N" and action == "canvas":
+            self._counts.append(0)
+        return number
+
+    def _atoms(self, *atoms):
+        return " ".join(escape(a) for a in atoms)
+
+    def canvas(self, x, y, width, height, name=None, vis=0, font=10):
+        """
+        Open the top level canvas, or a subpatch called name inside the
+        current one. A subpatch is closed with restore().
+        """
+        if name is None:
+            args = self._atoms(x, y, width, height, font)
+        else:
+            args = self._atoms(x, y, width, height, name, vis)
+        self.element("#N", "canvas", args)
+
+    def restore(self, x, y, *atoms):
+        """
+        Close the current subpatch, placing it on its parent as the object
+        given by atoms (usually "pd", name). Returns its object number.
+        """
+        return self.element("#X", "restore", self._atoms(x, y, *atoms))
+
+    def obj(self, x, y, *atoms):
+        return self.element("#X", "obj", self._atoms(x, y, *atoms))
+
+    def msg(self, x, y, *atoms):
+        return self.element("#X", "msg", self._atoms(x, y, *atoms))
+
+    def text(self, x, y, *atoms):
+        return self.element("#X", "text", self._atoms(x, y, *atoms))
+
+    def connect(self, fromObj, outlet, toObj, inlet):
+        self.element("#X", "connect",
+                     self._atoms(fromObj, outlet, toObj, inlet))
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -9,8 +9,10 @@ import time
 import sys
 
 PIPE = subprocess.PIPE
+# Python 3's subprocess no longer says whether it's on Windows
+mswindows = getattr(subprocess, "mswindows", os.name == "nt")
 
-if subprocess.mswindows:
+if mswindows:
     from win32file import ReadFile, WriteFile
     from win32pipe import PeekNamedPipe
     import msvcrt
@@ -40,7 +42,7 @@ class Popen(subprocess.Popen):
         getattr(self, which).close()
         setattr(self, which, None)
 
-    if subprocess.mswindows:
+    if mswindows:
         def send(self, input):
             if not self.stdin:
                 return None